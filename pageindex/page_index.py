@@ -4,6 +4,7 @@ import copy
 import math
 import random
 import re
+from statistics import NormalDist
 from .utils import *
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -11,7 +12,24 @@ import logging
 
 
 ################### check title in page #########################################################
-async def check_title_appearance(item, page_list, start_index=1, model=None):    
+def title_is_heading_locally(title, page_text, match_threshold, min_title_chars=8):
+    """
+    Whether a title clearly stands as a heading on a page: on a line of its own or opening the page.
+    Titles only mentioned in body text ("the results show ...") and very short titles do not count.
+    """
+    normalized_title = normalize_title_text(title)
+    if len(normalized_title) < min_title_chars or title_match_score(title, page_text) < match_threshold:
+        return False
+    if title_starts_page_locally(title, page_text) == 'yes':
+        return True
+    for line in page_text.splitlines():
+        # leave room for a heading number or page number on the same line
+        if len(normalize_title_text(line)) <= len(normalized_title) + 8 and title_match_score(title, line) >= match_threshold:
+            return True
+    return False
+
+
+async def check_title_appearance(item, page_list, start_index=1, model=None, match_threshold=None):    
     title=item['title']
     if 'physical_index' not in item or item['physical_index'] is None:
         return {'list_index': item.get('list_index'), 'answer': 'no', 'title':title, 'page_number': None}
@@ -19,6 +37,8 @@ async def check_title_appearance(item, page_list, start_index=1, model=None):
     
     page_number = item['physical_index']
     page_text = page_list[page_number-start_index][0]
+    if match_threshold is not None and title_is_heading_locally(title, page_text, match_threshold):
+        return {'list_index': item.get('list_index'), 'answer': 'yes', 'title': title, 'page_number': page_number}
 
     
     prompt = f"""
@@ -72,7 +92,167 @@ async def check_title_appearance_in_start(title, page_text, model=None, logger=N
     return response.get("start_begin", "no")
 
 
-async def check_title_appearance_in_start_concurrent(structure, page_list, model=None, logger=None):
+def locate_title_in_pages(title, page_list, first_page, last_page, start_index=1, match_threshold=0.9):
+    """
+    Find the physical index of the page a title is on without the LLM.
+    Returns None when no page matches well enough or when several do and it is unclear which one starts the section.
+    """
+    first_page = max(first_page, start_index)
+    last_page = min(last_page, start_index + len(page_list) - 1)
+    page_numbers = range(first_page, last_page + 1)
+    text_index = get_page_text_index(page_list)
+    if text_index is not None and start_index == 1:
+        # a page close enough to the title shares most of its n-grams, so only score those
+        ranked = text_index.query(title, first_page, last_page, top_k=len(page_numbers))
+        if ranked:
+            page_numbers = sorted(page_number for page_number, score in ranked if score >= 0.5)
+    candidates = [
+        page_number for page_number in page_numbers
+        if title_match_score(title, page_list[page_number-start_index][0]) >= match_threshold
+    ]
+    if len(candidates) == 1:
+        return candidates[0]
+    # running headers repeat titles on many pages, the one opening its page is the section start
+    starts = [page_number for page_number in candidates if title_starts_page_locally(title, page_list[page_number-start_index][0]) == 'yes']
+    if len(starts) == 1:
+        return starts[0]
+    return None
+
+
+def rank_candidate_pages(title, page_list, first_page, last_page, start_index=1, max_pages=None):
+    # the pages of the window, narrowed to the max_pages best n-gram matches of the title when the page list is indexed
+    first_page = max(first_page, start_index)
+    last_page = min(last_page, start_index + len(page_list) - 1)
+    page_numbers = list(range(first_page, last_page + 1))
+    text_index = get_page_text_index(page_list)
+    if not max_pages or text_index is None or start_index != 1 or len(page_numbers) <= max_pages:
+        return page_numbers
+    ranked = text_index.query(title, first_page, last_page, top_k=max_pages)
+    return sorted(page_number for page_number, _ in ranked) or page_numbers
+
+
+def pack_items_by_page(items, page_list, start_index=1, max_tokens=8000, max_items=20):
+    # group items sharing a physical_index, then pack neighbouring pages until the token budget is reached
+    items_by_page = {}
+    for item in items:
+        items_by_page.setdefault(item['physical_index'], []).append(item)
+
+    batches = []
+    current_pages, current_items, current_tokens = [], [], 0
+    for page_number in sorted(items_by_page):
+        page_items = items_by_page[page_number]
+        page_tokens = page_list[page_number-start_index][1]
+        if current_items and (current_tokens + page_tokens > max_tokens or len(current_items) + len(page_items) > max_items):
+            batches.append((current_pages, current_items))
+            current_pages, current_items, current_tokens = [], [], 0
+        current_pages.append(page_number)
+        current_items.extend(page_items)
+        current_tokens += page_tokens
+    if current_items:
+        batches.append((current_pages, current_items))
+    return batches
+
+
+def is_valid_physical_index(item, page_list, start_index=1):
+    physical_index = item.get('physical_index')
+    return isinstance(physical_index, int) and start_index <= physical_index < start_index + len(page_list)
+
+
+async def check_title_appearance_batch(pages, items, page_list, start_index=1, model=None, check_start=False):
+    """
+    Ask about all titles on a few neighbouring pages in one call.
+    Returns {id: 'yes' | 'no'} with id being the position in items; unanswered ids are left out.
+    """
+    page_text = ""
+    for page_number in pages:
+        page_text += f"<physical_index_{page_number}>\n{page_list[page_number-start_index][0]}\n<physical_index_{page_number}>\n\n"
+    sections = [{'id': i, 'title': item['title'], 'physical_index': item['physical_index']} for i, item in enumerate(items)]
+
+    if check_start:
+        task = """Your job is to check, for each given section, if the section starts in the beginning of its page (the page with the given physical_index).
+    If there are other contents before the section title on that page, then the section does not start in the beginning of the page.
+    If the section title is the first content on that page, then the section starts in the beginning of the page."""
+        answer_format = '"yes or no" (yes if the section starts in the beginning of its page, no otherwise)'
+    else:
+        task = """Your job is to check, for each given section, if the section appears or starts in its page (the page with the given physical_index)."""
+        answer_format = '"yes or no" (yes if the section appears or starts in its page, no otherwise)'
+
+    prompt = f"""
+    {task}
+
+    Note: do fuzzy matching, ignore any space inconsistency in the page text.
+
+    The provided pages contains tags like <physical_index_X> and <physical_index_X> to indicate the physical location of the page X.
+
+    The given sections are {json.dumps(sections, ensure_ascii=False)}.
+    The given pages are:
+    {page_text}
+
+    Reply format:
+    [
+        {{
+            "id": <id of the section>,
+            "answer": {answer_format}
+        }},
+        ...
+    ]
+    Answer for every given section. Directly return the final JSON structure. Do not output anything else."""
+
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
+    response = extract_json(response)
+    answers = {}
+    if isinstance(response, list):
+        for entry in response:
+            if not isinstance(entry, dict) or entry.get('answer') not in ('yes', 'no'):
+                continue
+            try:
+                item_id = int(entry.get('id'))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= item_id < len(items):
+                answers[item_id] = entry['answer']
+    return answers
+
+
+async def check_title_appearance_batched(items, page_list, start_index=1, model=None, max_tokens=8000, match_threshold=None):
+    """
+    Batched counterpart of check_title_appearance over many items, same result format.
+    Items the model skipped in a batch are re-checked one by one.
+    """
+    results = []
+    valid_items = []
+    for item in items:
+        if not is_valid_physical_index(item, page_list, start_index):
+            results.append({'list_index': item.get('list_index'), 'answer': 'no', 'title': item['title'], 'page_number': item.get('physical_index')})
+        elif match_threshold is not None and title_is_heading_locally(item['title'], page_list[item['physical_index']-start_index][0], match_threshold):
+            results.append({'list_index': item.get('list_index'), 'answer': 'yes', 'title': item['title'], 'page_number': item['physical_index']})
+        else:
+            valid_items.append(item)
+
+    batches = pack_items_by_page(valid_items, page_list, start_index, max_tokens)
+    batch_answers = await asyncio.gather(*[
+        check_title_appearance_batch(pages, batch_items, page_list, start_index, model)
+        for pages, batch_items in batches
+    ])
+
+    retry_items = []
+    for (pages, batch_items), answers in zip(batches, batch_answers):
+        for i, item in enumerate(batch_items):
+            if i in answers:
+                results.append({'list_index': item['list_index'], 'answer': answers[i], 'title': item['title'], 'page_number': item['physical_index']})
+            else:
+                retry_items.append(item)
+    if retry_items:
+        results.extend(await asyncio.gather(*[
+            check_title_appearance(item, page_list, start_index, model)
+            for item in retry_items
+        ]))
+
+    results.sort(key=lambda result: result['list_index'])
+    return results
+
+
+async def check_title_appearance_in_start_concurrent(structure, page_list, model=None, logger=None, batch_tokens=None):
     if logger:
         logger.info("Checking title appearance in start concurrently")
     
@@ -81,14 +261,40 @@ async def check_title_appearance_in_start_concurrent(structure, page_list, model
         if item.get('physical_index') is None:
             item['appear_start'] = 'no'
 
+    if batch_tokens:
+        valid_items = []
+        for item in structure:
+            if is_valid_physical_index(item, page_list):
+                valid_items.append(item)
+            elif item.get('physical_index') is not None:
+                item['appear_start'] = 'no'
+        batches = pack_items_by_page(valid_items, page_list, 1, batch_tokens)
+        results = await asyncio.gather(*[
+            check_title_appearance_batch(pages, batch_items, page_list, model=model, check_start=True)
+            for pages, batch_items in batches
+        ], return_exceptions=True)
+        pending_items = []
+        for (pages, batch_items), answers in zip(batches, results):
+            if isinstance(answers, Exception):
+                if logger:
+                    logger.error(f"Error checking start for pages {pages}: {answers}")
+                answers = {}
+            for i, item in enumerate(batch_items):
+                if i in answers:
+                    item['appear_start'] = answers[i]
+                else:
+                    # fall back to one call per item for anything the batches did not answer
+                    pending_items.append(item)
+    else:
+        pending_items = [item for item in structure if item.get('physical_index') is not None]
+
     # only for items with valid physical_index
     tasks = []
     valid_items = []
-    for item in structure:
-        if item.get('physical_index') is not None:
-            page_text = page_list[item['physical_index'] - 1][0]
-            tasks.append(check_title_appearance_in_start(item['title'], page_text, model=model, logger=logger))
-            valid_items.append(item)
+    for item in pending_items:
+        page_text = page_list[item['physical_index'] - 1][0]
+        tasks.append(check_title_appearance_in_start(item['title'], page_text, model=model, logger=logger))
+        valid_items.append(item)
 
     results = await asyncio.gather(*tasks, return_exceptions=True)
     for item, result in zip(valid_items, results):
@@ -102,7 +308,7 @@ async def check_title_appearance_in_start_concurrent(structure, page_list, model
     return structure
 
 
-def toc_detector_single_page(content, model=None):
+async def toc_detector_single_page(content, model=None):
     prompt = f"""
     Your job is to detect if there is a table of content provided in the given text.
 
@@ -117,13 +323,52 @@ def toc_detector_single_page(content, model=None):
     Directly return the final JSON structure. Do not output anything else.
     Please note: abstract,summary, notation list, figure list, table list, etc. are not table of contents."""
 
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     # print('response', response)
     json_content = extract_json(response)    
-    return json_content['toc_detected']
+    return json_content.get('toc_detected', 'no')
+
+
+TOC_KEYWORD_PATTERN = re.compile(r'^\s*(table\s+of\s+contents|contents|目\s*录|目\s*次)\s*$', re.IGNORECASE)
+NOT_TOC_KEYWORD_PATTERN = re.compile(r'list\s+of\s+(figures|tables|illustrations|abbreviations)|图\s*目\s*录|表\s*目\s*录|插图目录', re.IGNORECASE)
+DOT_LEADER_PATTERN = re.compile(r'(\.{4,}|…{2,}|·{4,}|(\.\s){4,})')
+TRAILING_PAGE_NUMBER_PATTERN = re.compile(r'(\s|\.|…|·)(\d{1,4}|[ivxlcdm]{1,7})\s*$', re.IGNORECASE)
+NUMBERED_HEADING_PATTERN = re.compile(r'^\s*(\d+(\.\d+)*\.?\s|chapter\s|section\s|part\s|appendix\s|第.{1,4}[章节部篇])', re.IGNORECASE)
+
+
+def detect_toc_page_locally(content):
+    """
+    Cheap layout-based guess whether a page is a table of contents.
+    Returns 'yes' or 'no' when the page is clear-cut, None when it should go to the model.
+    """
+    lines = [line.strip() for line in (content or '').splitlines() if line.strip()]
+    if len(lines) < 3:
+        return 'no'
+
+    head = lines[:5]
+    has_keyword = any(TOC_KEYWORD_PATTERN.match(line) for line in head)
+    if any(NOT_TOC_KEYWORD_PATTERN.search(line) for line in head):
+        # figure/table lists look exactly like a toc, let the model decide
+        return None
+
+    num_lines = len(lines)
+    dot_ratio = sum(1 for line in lines if DOT_LEADER_PATTERN.search(line)) / num_lines
+    page_number_ratio = sum(1 for line in lines if TRAILING_PAGE_NUMBER_PATTERN.search(line)) / num_lines
+    numbered_ratio = sum(1 for line in lines if NUMBERED_HEADING_PATTERN.match(line)) / num_lines
+    # CJK characters are about twice as wide as latin ones
+    average_width = sum(len(line) + len(CJK_PATTERN.findall(line)) for line in lines) / num_lines
 
+    # dot leaders and trailing numbers alone also fit financial highlights or notices, only a
+    # Contents heading makes a page definitely a toc; without one the model decides
+    if has_keyword and (page_number_ratio >= 0.3 or dot_ratio >= 0.2):
+        return 'yes'
+    if (not has_keyword and dot_ratio == 0 and page_number_ratio < 0.1
+            and numbered_ratio < 0.2 and average_width > 60):
+        return 'no'
+    return None
 
-def check_if_toc_extraction_is_complete(content, toc, model=None):
+
+async def check_if_toc_extraction_is_complete(content, toc, model=None):
     prompt = f"""
     You are given a partial document  and a  table of contents.
     Your job is to check if the  table of contents is complete, which it contains all the main sections in the partial document.
@@ -136,12 +381,12 @@ def check_if_toc_extraction_is_complete(content, toc, model=None):
     Directly return the final JSON structure. Do not output anything else."""
 
     prompt = prompt + '\n Document:\n' + content + '\n Table of contents:\n' + toc
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     json_content = extract_json(response)
-    return json_content['completed']
+    return json_content.get('completed', 'no')
 
 
-def check_if_toc_transformation_is_complete(content, toc, model=None):
+async def check_if_toc_transformation_is_complete(content, toc, model=None):
     prompt = f"""
     You are given a raw table of contents and a  table of contents.
     Your job is to check if the  table of contents is complete.
@@ -154,11 +399,11 @@ def check_if_toc_transformation_is_complete(content, toc, model=None):
     Directly return the final JSON structure. Do not output anything else."""
 
     prompt = prompt + '\n Raw Table of contents:\n' + content + '\n Cleaned Table of contents:\n' + toc
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     json_content = extract_json(response)
-    return json_content['completed']
+    return json_content.get('completed', 'no')
 
-def extract_toc_content(content, model=None):
+async def extract_toc_content(content, model=None, chunk_tokens=None):
     prompt = f"""
     Your job is to extract the full table of contents from the given text, replace ... with :
 
@@ -166,10 +411,16 @@ def extract_toc_content(content, model=None):
 
     Directly return the full table of contents content. Do not output anything else."""
 
-    response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
+    if chunk_tokens and count_tokens(content, model) > chunk_tokens:
+        # extract line-aligned parts concurrently instead of asking the model to continue its own output
+        chunks = split_toc_chunks(content, max_tokens=chunk_tokens, model=model)
+        parts = await asyncio.gather(*[extract_toc_content(chunk, model) for chunk in chunks])
+        return '\n'.join(part.strip() for part in parts)
+
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
     
-    if_complete = check_if_toc_transformation_is_complete(content, response, model)
-    if if_complete == "yes" and finish_reason == "finished":
+    if_complete = await check_if_toc_transformation_is_complete(content, response, model)
+    if if_complete == "yes" and is_finished(finish_reason):
         return response
     
     chat_history = [
@@ -177,19 +428,19 @@ def extract_toc_content(content, model=None):
         {"role": "assistant", "content": response},    
     ]
     prompt = f"""please continue the generation of table of contents , directly output the remaining part of the structure"""
-    new_response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt, chat_history=chat_history)
+    new_response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt, chat_history=chat_history)
     response = response + new_response
-    if_complete = check_if_toc_transformation_is_complete(content, response, model)
+    if_complete = await check_if_toc_transformation_is_complete(content, response, model)
     
-    while not (if_complete == "yes" and finish_reason == "finished"):
+    while not (if_complete == "yes" and is_finished(finish_reason)):
         chat_history = [
             {"role": "user", "content": prompt}, 
             {"role": "assistant", "content": response},    
         ]
         prompt = f"""please continue the generation of table of contents , directly output the remaining part of the structure"""
-        new_response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt, chat_history=chat_history)
+        new_response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt, chat_history=chat_history)
         response = response + new_response
-        if_complete = check_if_toc_transformation_is_complete(content, response, model)
+        if_complete = await check_if_toc_transformation_is_complete(content, response, model)
         
         # Optional: Add a maximum retry limit to prevent infinite loops
         if len(chat_history) > 5:  # Arbitrary limit of 10 attempts
@@ -197,7 +448,7 @@ def extract_toc_content(content, model=None):
     
     return response
 
-def detect_page_index(toc_content, model=None):
+async def detect_page_index(toc_content, model=None):
     print('start detect_page_index')
     prompt = f"""
     You will be given a table of contents.
@@ -213,11 +464,11 @@ def detect_page_index(toc_content, model=None):
     }}
     Directly return the final JSON structure. Do not output anything else."""
 
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     json_content = extract_json(response)
-    return json_content['page_index_given_in_toc']
+    return json_content.get('page_index_given_in_toc', 'no')
 
-def toc_extractor(page_list, toc_page_list, model):
+async def toc_extractor(page_list, toc_page_list, model):
     def transform_dots_to_colon(text):
         text = re.sub(r'\.{5,}', ': ', text)
         # Handle dots separated by spaces
@@ -228,7 +479,7 @@ def toc_extractor(page_list, toc_page_list, model):
     for page_index in toc_page_list:
         toc_content += page_list[page_index][0]
     toc_content = transform_dots_to_colon(toc_content)
-    has_page_index = detect_page_index(toc_content, model=model)
+    has_page_index = await detect_page_index(toc_content, model=model)
     
     return {
         "toc_content": toc_content,
@@ -238,7 +489,7 @@ def toc_extractor(page_list, toc_page_list, model):
 
 
 
-def toc_index_extractor(toc, content, model=None):
+async def toc_index_extractor(toc, content, model=None):
     print('start toc_index_extractor')
     tob_extractor_prompt = """
     You are given a table of contents in a json format and several pages of a document, your job is to add the physical_index to the table of contents in the json format.
@@ -262,14 +513,304 @@ def toc_index_extractor(toc, content, model=None):
     Directly return the final JSON structure. Do not output anything else."""
 
     prompt = tob_extractor_prompt + '\nTable of contents:\n' + str(toc) + '\nDocument pages:\n' + content
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     json_content = extract_json(response)    
     return json_content
 
 
 
-def toc_transformer(toc_content, model=None):
+TOC_ENTRY_NUMBER_PATTERN = re.compile(r'^(\d{1,2}(?:\.\d{1,3})*\.?(?=\s)|[A-Z](?:\.\d{1,3})+\.?(?=\s)|(?:chapter|part|section|appendix)\s+(?:\d+|[IVXLC]+|[A-Z])\b[.:]?|第[一二三四五六七八九十百零〇\d]+[章节部篇])\s*', re.IGNORECASE)
+TOC_ENTRY_PAGE_PATTERN = re.compile(r'(?:[:：]\s*|\s+)(\d{1,4}|m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3}))$')
+TOC_HEADING_KEYWORD_PATTERN = re.compile(r'^(chapter|part|section|appendix|第.{1,4}[章节部篇])$', re.IGNORECASE)
+
+
+def levels_to_structures(levels):
+    # turn heading depths into "1", "1.1", "1.2", "2" style structure indices, clamping skipped depths
+    structures = []
+    counters = []
+    for level in levels:
+        level = max(1, min(level, len(counters) + 1))
+        del counters[level:]
+        if len(counters) < level:
+            counters.append(0)
+        counters[level - 1] += 1
+        structures.append('.'.join(str(counter) for counter in counters))
+    return structures
+
+
+def split_toc_line(line, roman_pages=False):
+    # a roman page number right after a word ("3.2 Product mix") is only taken when roman_pages says
+    # the toc uses them on several lines; after a colon or dot leader it is always a page number
+    text = line.strip()
+    page = None
+    match = TOC_ENTRY_PAGE_PATTERN.search(text)
+    if match and match.group(1):
+        head = text[:match.start()].rstrip(' :：.·…')
+        separated = match.group(0)[0] in ':：' or text[:match.start()].endswith(('.', '·', '…'))
+        is_page = match.group(1).isdigit() or separated or roman_pages
+        # "Chapter 3" on its own is a heading number, not a page number
+        if is_page and head and not TOC_HEADING_KEYWORD_PATTERN.match(head):
+            page = int(match.group(1)) if match.group(1).isdigit() else match.group(1)
+            text = head
+    number = None
+    match = TOC_ENTRY_NUMBER_PATTERN.match(text)
+    if match:
+        number = match.group(1).rstrip('.:')
+    return number, text, page
+
+
+def number_depth(number):
+    if number is None:
+        return None
+    if re.match(r'^[\dA-Z]+(\.\d+)+$', number) or number.isdigit():
+        return number.count('.') + 1
+    if re.search(r'节$', number):
+        return 2
+    return 1
+
+
+def heading_keyword_rank(number):
+    # Part above Chapter above Section, for headings numbered with a word rather than 1.2.3
+    if number is None or number[0].isdigit():
+        return None
+    lowered = number.lower()
+    if lowered.startswith('part') or re.search(r'[部篇]$', number):
+        return 0
+    if lowered.startswith(('chapter', 'appendix')) or number.endswith('章'):
+        return 1
+    if lowered.startswith('section') or number.endswith('节'):
+        return 2
+    return None
+
+
+def is_next_number(previous, current):
+    # 1 -> 1.1, 1.2 -> 1.3, 1.3 -> 2, 2.1.4 -> 2.2 are all valid successors
+    prev_parts, parts = previous.split('.'), current.split('.')
+    if not all(part.isdigit() for part in prev_parts + parts):
+        return True
+    if len(parts) == len(prev_parts) + 1:
+        return parts[:-1] == prev_parts and int(parts[-1]) <= 1
+    if len(parts) > len(prev_parts) + 1:
+        return False
+    shared = prev_parts[:len(parts) - 1]
+    return parts[:-1] == shared and int(parts[-1]) == int(prev_parts[len(parts) - 1]) + 1
+
+
+def parse_toc_locally(toc_content):
+    """Parse a table of contents without the LLM.
+
+    Returns (toc, confidence) where toc has the same structure/title/page items as
+    toc_transformer and confidence in [0, 1] says how regular the parse looked.
+    """
+    raw_lines = [
+        raw_line for raw_line in toc_content.splitlines()
+        if raw_line.strip() and not TOC_KEYWORD_PATTERN.match(raw_line)
+        and not re.fullmatch(r'\s*(page|页码|\d{1,4})\s*', raw_line, re.IGNORECASE)
+    ]
+    # trailing words like "mix" or "civil" read as roman numerals, front matter pages come in runs
+    roman_pages = sum(1 for raw_line in raw_lines if isinstance(split_toc_line(raw_line, roman_pages=True)[2], str)) >= 3
+    lines = []
+    for raw_line in raw_lines:
+        indent = len(raw_line.expandtabs(4)) - len(raw_line.expandtabs(4).lstrip())
+        number, title, page = split_toc_line(raw_line, roman_pages=roman_pages)
+        lines.append({'indent': indent, 'number': number, 'title': title, 'page': page})
+    if not lines:
+        return [], 0.0
+
+    # join titles that wrapped onto a second line before their page number
+    with_page = sum(1 for line in lines if line['page'] is not None)
+    entries = []
+    for line in lines:
+        previous = entries[-1] if entries else None
+        if (previous is not None and previous['page'] is None and line['number'] is None
+                and with_page >= len(lines) / 2 and not (previous['number'] and line['page'] is None)):
+            previous['title'] = f"{previous['title']} {line['title']}"
+            previous['page'] = line['page']
+            continue
+        entries.append(dict(line))
+
+    indents = sorted({entry['indent'] for entry in entries})
+    use_indent = 1 < len(indents) <= 4
+    ranks = sorted({rank for rank in (heading_keyword_rank(entry['number']) for entry in entries) if rank is not None})
+    levels = []
+    heading_depth = 0
+    for entry in entries:
+        rank = heading_keyword_rank(entry['number'])
+        if rank is not None:
+            depth = heading_depth = ranks.index(rank) + 1
+        else:
+            depth = number_depth(entry['number'])
+        if depth is None:
+            # PyPDF2 text rarely keeps indentation, so unnumbered entries go under the Chapter/Part heading above them
+            depth = indents.index(entry['indent']) + 1 if use_indent else heading_depth + 1
+        levels.append(depth)
+
+    toc = [
+        {'structure': structure, 'title': entry['title'], 'page': entry['page']}
+        for structure, entry in zip(levels_to_structures(levels), entries)
+    ]
+
+    if len(toc) < 3:
+        return toc, 0.0
+    page_count = sum(1 for entry in entries if entry['page'] is not None)
+    page_ratio = page_count / len(entries)
+    if page_ratio == 0:
+        # without page numbers only explicit heading numbers tell entries apart from wrapped lines
+        page_score = sum(1 for entry in entries if entry['number']) / len(entries)
+    elif page_count == 1:
+        # a single page number in a longer toc is more likely a misread word or number than a page column
+        page_score = 0.5
+    else:
+        # a mix of lines with and without page numbers usually means the layout was misread
+        page_score = 1.0 if page_ratio >= 0.9 else max(page_ratio, 1 - page_ratio) ** 2
+    pages = [entry['page'] for entry in entries if isinstance(entry['page'], int)]
+    pairs = list(zip(pages, pages[1:]))
+    order_score = sum(1 for a, b in pairs if a <= b) / len(pairs) if pairs else 1.0
+    numbers = [entry['number'] for entry in entries if entry['number'] and entry['number'][0].isdigit()]
+    number_pairs = list(zip(numbers, numbers[1:]))
+    number_score = sum(1 for a, b in number_pairs if is_next_number(a, b)) / len(number_pairs) if number_pairs else 1.0
+    title_score = sum(1 for entry in entries if 0 < len(entry['title']) <= 150) / len(entries)
+    confidence = page_score * order_score * number_score * title_score
+    return toc, round(confidence, 3)
+
+
+def is_finished(finish_reason):
+    # the API reports "stop" for a complete answer and "length" when max_tokens cut it off
+    return finish_reason in ("stop", "finished")
+
+
+def split_toc_chunks(toc_content, max_tokens=2000, model=None):
+    """Split raw table of contents text into line-aligned chunks of about max_tokens each.
+
+    A chunk never ends on a line without a page number when the next line continues it,
+    so wrapped titles stay in one chunk.
+    """
+    lines = [line for line in toc_content.splitlines() if line.strip()]
+    if not lines:
+        return []
+    token_lengths = count_tokens_batch(lines, model)
+    chunks = []
+    current, current_tokens = [], 0
+    for i, (line, tokens) in enumerate(zip(lines, token_lengths)):
+        if current and current_tokens + tokens > max_tokens:
+            _, _, previous_page = split_toc_line(current[-1])
+            next_number, _, _ = split_toc_line(line)
+            # give a wrapped title a little slack before cutting
+            if previous_page is not None or next_number is not None or current_tokens + tokens > max_tokens * 1.25:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+async def transform_toc_chunk(chunk, context, model=None):
+    prompt = f"""
+    You are given one part of a longer table of contents. Your job is to transform every entry of this part into JSON.
+
+    level is the depth of the entry in the hierarchy of the whole table of contents: 1 for top-level sections, 2 for their subsections, etc.
+    The lines before this part are given as context only, to help you judge the level of the first entries. Do not include them in the output.
+
+    The response should be in the following JSON format:
+    [
+        {{
+            "level": <hierarchy depth> (integer),
+            "title": <title of the section>,
+            "page": <page number or None>
+        }},
+        ...
+    ]
+    Directly return the final JSON structure, do not output anything else.
+
+    Context lines:
+    {context}
+
+    Part to transform:
+    {chunk}"""
+
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
+    lines = chunk.splitlines()
+    if finish_reason == "length" and len(lines) >= 2:
+        # the answer was cut off: split the part in two and transform both halves concurrently
+        middle = len(lines) // 2
+        head, tail = '\n'.join(lines[:middle]), '\n'.join(lines[middle:])
+        results = await asyncio.gather(
+            transform_toc_chunk(head, context, model),
+            transform_toc_chunk(tail, '\n'.join(lines[max(0, middle - 3):middle]), model),
+        )
+        return results[0] + results[1]
+    # a failed request or an unreadable answer must not pass for a part without entries
+    items = extract_json(response) if finish_reason != "error" else None
+    if not isinstance(items, list):
+        raise Exception(f'Failed to transform table of contents part (finish_reason: {finish_reason})')
+    return items
+
+
+def parse_level(value):
+    try:
+        return max(1, int(value or 1))
+    except (TypeError, ValueError):
+        return 1
+
+
+def reconcile_levels(parts):
+    """
+    One hierarchy depth per item for (title, level) lists produced part by part.
+    Explicit heading numbers in the titles win; the model only saw its own part, so the other levels
+    are shifted to line up with the part's first numbered heading.
+    """
+    depths = []
+    for entries in parts:
+        numbered = [number_depth(split_toc_line(title)[0]) for title, _ in entries]
+        shift = next((depth - level for (_, level), depth in zip(entries, numbered) if depth is not None), 0)
+        for (_, level), depth in zip(entries, numbered):
+            depths.append(depth if depth is not None else max(1, level + shift))
+    return depths
+
+
+def stitch_toc_chunks(chunk_results):
+    # rebuild one structure numbering across chunks
+    toc = []
+    parts = []
+    for items in chunk_results:
+        entries = []
+        for item in items:
+            title = str(item.get('title') or '').strip()
+            if title:
+                entries.append((title, parse_level(item.get('level'))))
+                toc.append({'title': title, 'page': item.get('page')})
+        parts.append(entries)
+    return [
+        {'structure': structure, 'title': item['title'], 'page': item['page']}
+        for structure, item in zip(levels_to_structures(reconcile_levels(parts)), toc)
+    ]
+
+
+async def toc_transformer_chunked(toc_content, model=None, chunk_tokens=2000):
+    print('start toc_transformer_chunked')
+    chunks = split_toc_chunks(toc_content, max_tokens=chunk_tokens, model=model)
+    contexts = [''] + ['\n'.join(chunk.splitlines()[-3:]) for chunk in chunks[:-1]]
+    chunk_results = await asyncio.gather(*[
+        transform_toc_chunk(chunk, context, model) for chunk, context in zip(chunks, contexts)
+    ])
+    return convert_page_to_int(stitch_toc_chunks(chunk_results))
+
+
+async def toc_transformer(toc_content, model=None, min_local_confidence=None, chunk_tokens=None):
     print('start toc_transformer')
+    if min_local_confidence is not None:
+        local_toc, confidence = parse_toc_locally(toc_content)
+        print(f'local toc parse confidence: {confidence}')
+        if local_toc and confidence >= min_local_confidence:
+            return local_toc
+    if chunk_tokens and count_tokens(toc_content, model) > chunk_tokens:
+        try:
+            return await toc_transformer_chunked(toc_content, model, chunk_tokens=chunk_tokens)
+        except Exception as e:
+            print(f'chunked toc transformation failed, transforming in one pass: {e}')
+
     init_prompt = """
     You are given a table of contents, You job is to transform the whole table of content into a JSON format included table_of_contents.
 
@@ -290,15 +831,15 @@ def toc_transformer(toc_content, model=None):
     Directly return the final JSON structure, do not output anything else. """
 
     prompt = init_prompt + '\n Given table of contents\n:' + toc_content
-    last_complete, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
-    if_complete = check_if_toc_transformation_is_complete(toc_content, last_complete, model)
-    if if_complete == "yes" and finish_reason == "finished":
+    last_complete, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
+    if_complete = await check_if_toc_transformation_is_complete(toc_content, last_complete, model)
+    if if_complete == "yes" and is_finished(finish_reason):
         last_complete = extract_json(last_complete)
         cleaned_response=convert_page_to_int(last_complete['table_of_contents'])
         return cleaned_response
     
     last_complete = get_json_content(last_complete)
-    while not (if_complete == "yes" and finish_reason == "finished"):
+    while not (if_complete == "yes" and is_finished(finish_reason)):
         position = last_complete.rfind('}')
         if position != -1:
             last_complete = last_complete[:position+2]
@@ -314,13 +855,13 @@ def toc_transformer(toc_content, model=None):
 
         Please continue the json structure, directly output the remaining part of the json structure."""
 
-        new_complete, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
+        new_complete, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
 
         if new_complete.startswith('```json'):
             new_complete =  get_json_content(new_complete)
             last_complete = last_complete+new_complete
 
-        if_complete = check_if_toc_transformation_is_complete(toc_content, last_complete, model)
+        if_complete = await check_if_toc_transformation_is_complete(toc_content, last_complete, model)
         
 
     last_complete = json.loads(last_complete)
@@ -331,27 +872,77 @@ def toc_transformer(toc_content, model=None):
 
 
 
-def find_toc_pages(start_page_index, page_list, opt, logger=None):
+async def transform_toc(toc_content, model=None, min_local_confidence=None, chunk_tokens=None, memo=None):
+    # toc_transformer runs once per toc_content and document, fallback modes reuse its result
+    if memo is not None:
+        toc = memo.get_transformed_toc(toc_content)
+        if toc is not None:
+            return toc
+    toc = await toc_transformer(toc_content, model, min_local_confidence=min_local_confidence, chunk_tokens=chunk_tokens)
+    if memo is not None:
+        memo.set_transformed_toc(toc_content, toc)
+    return toc
+
+
+async def find_toc_pages(start_page_index, page_list, opt, logger=None, detected=None):
     print('start find_toc_pages')
+    use_prefilter = opt.toc_page_prefilter == 'yes'
+    # check_toc searches the same window again from later pages, results are shared through detected
+    if detected is None:
+        detected = {}
+    pending = {}
+
+    def local_result(i):
+        if i not in detected and use_prefilter:
+            detected_result = detect_toc_page_locally(page_list[i][0])
+            if detected_result is not None:
+                detected[i] = detected_result
+        return detected.get(i)
+
+    async def model_result(i):
+        if i in pending:
+            detected_result = await pending.pop(i)
+        else:
+            detected_result = await toc_detector_single_page(page_list[i][0], model=opt.model)
+        detected[i] = detected_result
+        return detected_result
+
     last_page_is_yes = False
     toc_page_list = []
     i = start_page_index
     
-    while i < len(page_list):
-        # Only check beyond max_pages if we're still finding TOC pages
-        if i >= opt.toc_check_page_num and not last_page_is_yes:
-            break
-        detected_result = toc_detector_single_page(page_list[i][0],model=opt.model)
-        if detected_result == 'yes':
-            if logger:
-                logger.info(f'Page {i} has toc')
-            toc_page_list.append(i)
-            last_page_is_yes = True
-        elif detected_result == 'no' and last_page_is_yes:
-            if logger:
-                logger.info(f'Found the last page with toc: {i-1}')
-            break
-        i += 1
+    try:
+        while i < len(page_list):
+            # Only check beyond max_pages if we're still finding TOC pages
+            if i >= opt.toc_check_page_num and not last_page_is_yes:
+                break
+            await wait_for_pages(page_list, i + 1)
+            detected_result = local_result(i)
+            if detected_result is None:
+                if use_prefilter and not last_page_is_yes and i not in pending:
+                    # every page is checked until the toc starts, so a run of pages the local scorer
+                    # is unsure about goes to the model concurrently; inside the toc it stays page by page
+                    run_end = min(opt.toc_check_page_num, len(page_list))
+                    await wait_for_pages(page_list, run_end)
+                    j = i
+                    while j < run_end and local_result(j) is None:
+                        pending[j] = asyncio.create_task(toc_detector_single_page(page_list[j][0], model=opt.model))
+                        j += 1
+                detected_result = await model_result(i)
+            if detected_result == 'yes':
+                if logger:
+                    logger.info(f'Page {i} has toc')
+                toc_page_list.append(i)
+                last_page_is_yes = True
+            elif detected_result == 'no' and last_page_is_yes:
+                if logger:
+                    logger.info(f'Found the last page with toc: {i-1}')
+                break
+            i += 1
+    finally:
+        # pages past the end of the toc are not needed
+        for task in pending.values():
+            task.cancel()
     
     if not toc_page_list and logger:
         logger.info('No toc found')
@@ -370,20 +961,48 @@ def remove_page_number(data):
     return data
 
 def extract_matching_page_pairs(toc_page, toc_physical_index, start_page_index):
+    # join on normalized titles; repeated titles pair up in toc order
+    toc_entries = {}
+    for list_index, page_item in enumerate(toc_page):
+        toc_entries.setdefault(normalize_title_text(page_item.get('title')), []).append((list_index, page_item))
+
     pairs = []
     for phy_item in toc_physical_index:
-        for page_item in toc_page:
-            if phy_item.get('title') == page_item.get('title'):
-                physical_index = phy_item.get('physical_index')
-                if physical_index is not None and int(physical_index) >= start_page_index:
-                    pairs.append({
-                        'title': phy_item.get('title'),
-                        'page': page_item.get('page'),
-                        'physical_index': physical_index
-                    })
+        entries = toc_entries.get(normalize_title_text(phy_item.get('title')))
+        if not entries:
+            continue
+        list_index, page_item = entries.pop(0)
+        physical_index = phy_item.get('physical_index')
+        if physical_index is not None and int(physical_index) >= start_page_index:
+            pairs.append({
+                'title': phy_item.get('title'),
+                'page': page_item.get('page'),
+                'physical_index': physical_index,
+                'list_index': list_index
+            })
     return pairs
 
 
+def locate_page_pairs(toc_page, pairs, page_list, first_page, match_threshold=0.9):
+    # extra pairs for toc items found verbatim anywhere after the toc, so offsets can be fitted over the whole document
+    if get_page_text_index(page_list) is None:
+        return []
+    paired = {pair.get('list_index') for pair in pairs}
+    located = []
+    for list_index, item in enumerate(toc_page):
+        if list_index in paired or not isinstance(item.get('page'), int):
+            continue
+        physical_index = locate_title_in_pages(item['title'], page_list, first_page, len(page_list), match_threshold=match_threshold)
+        if physical_index is not None:
+            located.append({
+                'title': item['title'],
+                'page': item['page'],
+                'physical_index': physical_index,
+                'list_index': list_index
+            })
+    return located
+
+
 def calculate_page_offset(pairs):
     differences = []
     for pair in pairs:
@@ -406,52 +1025,169 @@ def calculate_page_offset(pairs):
     
     return most_common
 
+def fit_page_offsets(pairs, toc_page, switch_penalty=1.5):
+    """
+    Fit a piecewise constant page offset along the toc order to the matched pairs.
+    Each matched pair votes for its own offset; changing offset costs switch_penalty votes and is only
+    allowed where it keeps physical pages in order, so a few bad matches do not split the toc.
+    Returns [(list_index, offset), ...] breakpoints, each offset holding until the next breakpoint.
+    """
+    anchors = {}
+    for pair in pairs:
+        list_index = pair.get('list_index')
+        if list_index is None or not isinstance(pair.get('page'), int) or not isinstance(pair.get('physical_index'), int):
+            continue
+        anchors.setdefault(list_index, (pair['page'], pair['physical_index'] - pair['page']))
+    if not anchors:
+        offset = calculate_page_offset(pairs)
+        return [] if offset is None else [(0, offset)]
+
+    anchors = sorted((list_index, page, offset) for list_index, (page, offset) in anchors.items())
+    offsets = sorted({offset for _, _, offset in anchors})
+    costs = {offset: 0 if offset == anchors[0][2] else 1 for offset in offsets}
+    back_pointers = []
+    for (_, prev_page, _), (_, page, observed) in zip(anchors, anchors[1:]):
+        new_costs, pointers = {}, {}
+        for offset in offsets:
+            best_cost, best_prev = None, None
+            for prev_offset in offsets:
+                if prev_offset != offset and page >= prev_page and page + offset < prev_page + prev_offset:
+                    continue
+                cost = costs[prev_offset] + (0 if prev_offset == offset else switch_penalty)
+                if best_cost is None or cost < best_cost:
+                    best_cost, best_prev = cost, prev_offset
+            new_costs[offset] = best_cost + (0 if observed == offset else 1)
+            pointers[offset] = best_prev
+        back_pointers.append(pointers)
+        costs = new_costs
+
+    offset = min(costs, key=lambda candidate: (costs[candidate], candidate))
+    fitted = [offset]
+    for pointers in reversed(back_pointers):
+        offset = pointers[offset]
+        fitted.append(offset)
+    fitted.reverse()
+
+    breakpoints = [(0, fitted[0])]
+    for k in range(1, len(anchors)):
+        if fitted[k] == fitted[k - 1]:
+            continue
+        prev_index, prev_page, _ = anchors[k - 1]
+        index, page, _ = anchors[k]
+        # the switch happens where page numbers restart or once an item is closer to the next anchor
+        breakpoint = index
+        last_page = prev_page
+        for j in range(prev_index + 1, index + 1):
+            page_j = toc_page[j].get('page')
+            if not isinstance(page_j, int):
+                continue
+            if page_j < last_page or (page >= prev_page and page_j - prev_page > page - page_j):
+                breakpoint = j
+                break
+            last_page = page_j
+        breakpoints.append((breakpoint, fitted[k]))
+    return breakpoints
+
+
 def add_page_offset_to_toc_json(data, offset):
+    # offset is either one offset for the whole toc or the [(list_index, offset), ...] breakpoints of fit_page_offsets
+    breakpoints = offset if isinstance(offset, list) else [(0, offset)]
+    if not breakpoints or breakpoints[0][1] is None:
+        return data
+    position = 0
     for i in range(len(data)):
+        while position + 1 < len(breakpoints) and breakpoints[position + 1][0] <= i:
+            position += 1
         if data[i].get('page') is not None and isinstance(data[i]['page'], int):
-            data[i]['physical_index'] = data[i]['page'] + offset
+            data[i]['physical_index'] = data[i]['page'] + breakpoints[position][1]
             del data[i]['page']
     
     return data
 
 
 
-def page_list_to_group_text(page_contents, token_lengths, max_tokens=20000, overlap_page=1):    
+def page_list_to_group_ranges(token_lengths, max_tokens=20000, overlap_page=1, balance=False):
+    """
+    Split pages into groups of at most about max_tokens, returned as [start, end) index ranges.
+    Consecutive groups share overlap_page pages. With balance the pages of each group (overlap aside)
+    are evened out for concurrent processing instead of filling groups up to the budget.
+    """
     num_tokens = sum(token_lengths)
-    
     if num_tokens <= max_tokens:
-        # merge all pages into one text
-        page_text = "".join(page_contents)
-        return [page_text]
-    
-    subsets = []
-    current_subset = []
-    current_token_count = 0
+        return [(0, len(token_lengths))]
 
     expected_parts_num = math.ceil(num_tokens / max_tokens)
     average_tokens_per_part = math.ceil(((num_tokens / expected_parts_num) + max_tokens) / 2)
-    
-    for i, (page_content, page_tokens) in enumerate(zip(page_contents, token_lengths)):
-        if current_token_count + page_tokens > average_tokens_per_part:
-
-            subsets.append(''.join(current_subset))
-            # Start new subset from overlap if specified
-            overlap_start = max(i - overlap_page, 0)
-            current_subset = page_contents[overlap_start:i]
-            current_token_count = sum(token_lengths[overlap_start:i])
-        
-        # Add current page to the subset
-        current_subset.append(page_content)
+    # balanced groups also carry the overlap pages, so plan the group count with room for them
+    overlap_tokens = num_tokens / len(token_lengths) * overlap_page
+    balanced_parts_num = math.ceil(num_tokens / max(max_tokens - overlap_tokens, max_tokens / 2))
+
+    if balance:
+        return balanced_group_ranges(token_lengths, max_tokens, overlap_page, balanced_parts_num)
+
+    ranges = []
+    start = 0
+    own_start = 0
+    current_token_count = 0
+    for i, page_tokens in enumerate(token_lengths):
+        split = current_token_count + page_tokens > average_tokens_per_part
+        # a group always gets at least one page of its own besides the overlap
+        if split and i > own_start:
+            ranges.append((start, i))
+            start = max(i - overlap_page, 0)
+            own_start = i
+            current_token_count = sum(token_lengths[start:i])
         current_token_count += page_tokens
+    ranges.append((start, len(token_lengths)))
+    return ranges
+
+
+def balanced_group_ranges(token_lengths, max_tokens, overlap_page, parts_num):
+    # cut where the running total is closest to k * total / parts_num, so rounding does not pile up
+    # in the last group; a group that would exceed max_tokens with its overlap is cut early
+    tokens_per_part = sum(token_lengths) / parts_num
+    ranges = []
+    start = 0
+    own_start = 0
+    covered_tokens = 0
+    k = 1
+    for i, page_tokens in enumerate(token_lengths):
+        target = k * tokens_per_part
+        at_target = covered_tokens + page_tokens - target > target - covered_tokens
+        over_budget = sum(token_lengths[start:i]) + page_tokens > max_tokens
+        if (at_target or over_budget) and i > own_start:
+            ranges.append((start, i))
+            start = max(i - overlap_page, 0)
+            own_start = i
+            k = k + 1 if at_target else max(k, math.floor(covered_tokens / tokens_per_part) + 1)
+        covered_tokens += page_tokens
+    ranges.append((start, len(token_lengths)))
+    return ranges
+
+
+def page_token_lengths(page_list, start_index=1, model=None):
+    # token length of every page together with its physical_index tags, reusing the counts already in page_list
+    last_index = start_index + len(page_list)
+    tag_tokens = count_tokens(f"<physical_index_{last_index}>\n\n<physical_index_{last_index}>\n\n", model)
+    return [page_tokens + tag_tokens for _, page_tokens in page_list]
+
+
+def page_range_to_group_text(page_list, page_range, start_index=1):
+    # the tagged text of one group, built only when its prompt is
+    start, end = page_range
+    return ''.join(
+        f"<physical_index_{i + start_index}>\n{page_list[i][0]}\n<physical_index_{i + start_index}>\n\n"
+        for i in range(start, end)
+    )
 
-    # Add the last subset if it contains any pages
-    if current_subset:
-        subsets.append(''.join(current_subset))
-    
-    print('divide page_list to groups', len(subsets))
-    return subsets
 
-def add_page_number_to_toc(part, structure, model=None):
+def page_list_to_group_text(page_contents, token_lengths, max_tokens=20000, overlap_page=1):    
+    group_ranges = page_list_to_group_ranges(token_lengths, max_tokens, overlap_page)
+    if len(group_ranges) > 1:
+        print('divide page_list to groups', len(group_ranges))
+    return [''.join(page_contents[start:end]) for start, end in group_ranges]
+
+async def add_page_number_to_toc(part, structure, model=None):
     fill_prompt_seq = """
     You are given an JSON structure of a document and a partial part of the document. Your task is to check if the title that is described in the structure is started in the partial given document.
 
@@ -475,7 +1211,7 @@ def add_page_number_to_toc(part, structure, model=None):
     Directly return the final JSON structure. Do not output anything else."""
 
     prompt = fill_prompt_seq + f"\n\nCurrent Partial Document:\n{part}\n\nGiven Structure\n{json.dumps(structure, indent=2)}\n"
-    current_json_raw = ChatGPT_API(model=model, prompt=prompt)
+    current_json_raw = await ChatGPT_API_async(model=model, prompt=prompt)
     json_result = extract_json(current_json_raw)
     
     for item in json_result:
@@ -497,7 +1233,7 @@ def remove_first_physical_index_section(text):
     return text
 
 ### add verify completeness
-def generate_toc_continue(toc_content, part, model="gpt-4o-2024-11-20"):
+async def generate_toc_continue(toc_content, part, model="gpt-4o-2024-11-20"):
     """
     继续生成目录结构
     """
@@ -527,7 +1263,7 @@ def generate_toc_continue(toc_content, part, model="gpt-4o-2024-11-20"):
     5. 新生成的结构应该与现有结构保持一致的风格
     """
     
-    response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
     
     if not response:
         return toc_content
@@ -559,7 +1295,7 @@ def generate_toc_continue(toc_content, part, model="gpt-4o-2024-11-20"):
         return toc_content
 
 ### add verify completeness
-def generate_toc_init(part, model=None):
+async def generate_toc_init(part, model=None):
     """
     生成初始目录结构
     """
@@ -585,7 +1321,7 @@ def generate_toc_init(part, model=None):
     4. 确保JSON格式正确，可以被解析
     """
     
-    response, finish_reason = ChatGPT_API_with_finish_reason(model=model, prompt=prompt)
+    response, finish_reason = await ChatGPT_API_with_finish_reason_async(model=model, prompt=prompt)
     
     if not response:
         return []
@@ -610,20 +1346,99 @@ def generate_toc_init(part, model=None):
         logging.error(f"生成目录结构时发生错误: {str(e)}")
         return []
 
-def process_no_toc(page_list, start_index=1, model=None, logger=None):
-    page_contents=[]
-    token_lengths=[]
-    for page_index in range(start_index, start_index+len(page_list)):
-        page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
-        page_contents.append(page_text)
-        token_lengths.append(count_tokens(page_text, model))
-    group_texts = page_list_to_group_text(page_contents, token_lengths)
-    logger.info(f'len(group_texts): {len(group_texts)}')
-
-    toc_with_page_number= generate_toc_init(group_texts[0], model)
-    for group_text in group_texts[1:]:
-        toc_with_page_number_additional = generate_toc_continue(toc_with_page_number, group_text, model)    
-        toc_with_page_number.extend(toc_with_page_number_additional)
+async def generate_toc_part(part, model=None):
+    """
+    为长文档中的一段内容独立生成目录结构（不依赖其他部分的结果，可并发调用）
+    """
+    prompt = f"""你是一个专业的文档结构分析专家。下面是一份长文档中的一段内容，前后还有其他内容。请找出在这段内容中开始的章节标题，生成包含标题、页码和层级的结构化目录。
+
+    文档内容：
+    {part}
+
+    请按照以下JSON格式返回目录结构：
+    [
+        {{
+            "title": "章节标题",
+            "physical_index": 页码数字,
+            "appear_start": "yes/no" (标题是否在该页开头出现),
+            "level": 层级数字 (1表示一级标题，2表示二级标题，以此类推)
+        }},
+        ...
+    ]
+
+    注意：
+    1. 只返回JSON格式的结果，不要包含其他说明文字
+    2. physical_index必须是数字
+    3. appear_start必须是"yes"或"no"
+    4. 确保JSON格式正确，可以被解析
+    """
+
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
+    result = extract_json(response)
+    if isinstance(result, dict):
+        result = [result] if result else []
+    if not isinstance(result, list):
+        return []
+    return convert_physical_index_to_int([item for item in result if isinstance(item, dict)])
+
+
+def merge_toc_parts(part_results):
+    """
+    Reduce step for structures generated group by group: drop the duplicates the overlapping pages
+    produce, restore page order and rebuild one structure numbering from the reconciled levels.
+    """
+    parts = []
+    items = []
+    for group_number, part in enumerate(part_results):
+        entries = []
+        for position, item in enumerate(part):
+            title = str(item.get('title') or '').strip()
+            if not title or not isinstance(item.get('physical_index'), int):
+                continue
+            entries.append((title, parse_level(item.get('level'))))
+            items.append((item['physical_index'], group_number, position, title, item.get('appear_start', 'no')))
+        parts.append(entries)
+
+    merged = []
+    seen = {}
+    for depth, (physical_index, _, _, title, appear_start) in sorted(
+            zip(reconcile_levels(parts), items), key=lambda entry: entry[1][:3]):
+        key = (normalize_title_text(title), physical_index)
+        if key in seen:
+            # the same heading seen from both groups sharing its page
+            if appear_start == 'yes':
+                seen[key]['appear_start'] = 'yes'
+            continue
+        seen[key] = {'title': title, 'physical_index': physical_index, 'appear_start': appear_start}
+        merged.append((depth, seen[key]))
+
+    structures = levels_to_structures([depth for depth, _ in merged])
+    return [{'structure': structure, **item} for structure, (_, item) in zip(structures, merged)]
+
+
+async def process_no_toc(page_list, start_index=1, model=None, logger=None, map_reduce=False, group_max_tokens=20000, context_tokens=None, balance_groups=False, memo=None):
+    memo = memo if memo is not None else StageMemo()
+    token_lengths = memo.remember('page_token_lengths', (start_index, len(page_list)), lambda: page_token_lengths(page_list, start_index, model))
+    # without a fixed size, leave room for the prompt and for the structure the sequential path carries along;
+    # every heading of a group has to fit in one answer, so groups are also capped by the output budget
+    max_tokens = group_max_tokens or group_token_budget(model, prompt_tokens=2000, context_tokens=context_tokens, input_per_output_token=5)
+    balance = balance_groups and map_reduce
+    group_ranges = memo.remember('group_ranges', (start_index, len(page_list), max_tokens, balance),
+                                 lambda: page_list_to_group_ranges(token_lengths, max_tokens, balance=balance))
+    logger.info(f'len(group_texts): {len(group_ranges)}')
+
+    if map_reduce and len(group_ranges) > 1:
+        part_results = await asyncio.gather(*[
+            generate_toc_part(page_range_to_group_text(page_list, group_range, start_index), model)
+            for group_range in group_ranges
+        ])
+        toc_with_page_number = merge_toc_parts(part_results)
+    else:
+        toc_with_page_number= await generate_toc_init(page_range_to_group_text(page_list, group_ranges[0], start_index), model)
+        for group_range in group_ranges[1:]:
+            # generate_toc_continue appends to the structure it is given and returns it
+            group_text = page_range_to_group_text(page_list, group_range, start_index)
+            toc_with_page_number = await generate_toc_continue(toc_with_page_number, group_text, model)
     logger.info(f'generate_toc: {toc_with_page_number}')
 
     toc_with_page_number = convert_physical_index_to_int(toc_with_page_number)
@@ -631,33 +1446,103 @@ def process_no_toc(page_list, start_index=1, model=None, logger=None):
 
     return toc_with_page_number
 
-def process_toc_no_page_numbers(toc_content, toc_page_list, page_list,  start_index=1, model=None, logger=None):
-    page_contents=[]
-    token_lengths=[]
-    toc_content = toc_transformer(toc_content, model)
+def reconcile_group_page_numbers(toc, group_results, group_ranges):
+    """
+    Combine add_page_number_to_toc answers obtained for every group independently against the same toc.
+    group_ranges are the (first, last) physical indices of each group's pages. Each item takes its earliest hit that lies inside the pages of the group reporting it and does not
+    come before the previous item; items without such a hit are left without physical_index.
+    """
+    positions = {}
+    for list_index, item in enumerate(toc):
+        positions.setdefault(normalize_title_text(item.get('title')), []).append(list_index)
+
+    candidates = [[] for _ in toc]
+    for result, (first_page, last_page) in zip(group_results, group_ranges):
+        if not isinstance(result, list):
+            continue
+        last_index = -1
+        for i, item in enumerate(result):
+            if not isinstance(item, dict):
+                continue
+            key = normalize_title_text(item.get('title'))
+            if len(result) == len(toc) and normalize_title_text(toc[i].get('title')) == key:
+                list_index = i
+            else:
+                # the answer dropped items, find the next toc item with this title instead
+                list_index = next((position for position in positions.get(key, []) if position > last_index), None)
+                if list_index is None:
+                    continue
+            last_index = list_index
+            physical_index = item.get('physical_index')
+            if isinstance(physical_index, str):
+                try:
+                    physical_index = convert_physical_index_to_int(physical_index)
+                except ValueError:
+                    continue
+            if isinstance(physical_index, int) and first_page <= physical_index <= last_page:
+                candidates[list_index].append(physical_index)
+
+    reconciled = copy.deepcopy(toc)
+    previous = None
+    for item, hits in zip(reconciled, candidates):
+        hits = sorted(hit for hit in hits if previous is None or hit >= previous)
+        item['physical_index'] = hits[0] if hits else None
+        if hits:
+            previous = hits[0]
+    return reconciled
+
+
+async def process_toc_no_page_numbers(toc_content, toc_page_list, page_list,  start_index=1, model=None, logger=None, min_local_confidence=None, chunk_tokens=None, concurrent_groups=False, group_max_tokens=20000, context_tokens=None, balance_groups=False, memo=None):
+    memo = memo if memo is not None else StageMemo()
+    toc_content = await transform_toc(toc_content, model, min_local_confidence=min_local_confidence, chunk_tokens=chunk_tokens, memo=memo)
     logger.info(f'toc_transformer: {toc_content}')
-    for page_index in range(start_index, start_index+len(page_list)):
-        page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
-        page_contents.append(page_text)
-        token_lengths.append(count_tokens(page_text, model))
+    token_lengths = memo.remember('page_token_lengths', (start_index, len(page_list)), lambda: page_token_lengths(page_list, start_index, model))
+    if group_max_tokens:
+        max_tokens = group_max_tokens
+    else:
+        # every prompt carries the toc json, and the answer is that toc annotated with physical indices:
+        # its size follows the toc, not the pages in the group, so only the context window limits the group
+        toc_tokens = count_tokens(json.dumps(toc_content, indent=2), model)
+        max_tokens = group_token_budget(model, prompt_tokens=toc_tokens + 1000, output_tokens=max(int(toc_tokens * 1.2), LLM_SAMPLING_PARAMS["max_tokens"]), context_tokens=context_tokens)
     
-    group_texts = page_list_to_group_text(page_contents, token_lengths)
-    logger.info(f'len(group_texts): {len(group_texts)}')
-
-    toc_with_page_number=copy.deepcopy(toc_content)
-    for group_text in group_texts:
-        toc_with_page_number = add_page_number_to_toc(group_text, toc_with_page_number, model)
+    balance = balance_groups and concurrent_groups
+    group_ranges = memo.remember('group_ranges', (start_index, len(page_list), max_tokens, balance),
+                                 lambda: page_list_to_group_ranges(token_lengths, max_tokens, balance=balance))
+    logger.info(f'len(group_texts): {len(group_ranges)}')
+
+    if concurrent_groups and len(group_ranges) > 1:
+        group_results = await asyncio.gather(*[
+            add_page_number_to_toc(page_range_to_group_text(page_list, group_range, start_index), copy.deepcopy(toc_content), model)
+            for group_range in group_ranges
+        ], return_exceptions=True)
+        for group_number, result in enumerate(group_results):
+            if isinstance(result, Exception):
+                logger.error(f'add_page_number_to_toc failed for group {group_number}: {result}')
+        physical_ranges = [(start + start_index, end - 1 + start_index) for start, end in group_ranges]
+        toc_with_page_number = reconcile_group_page_numbers(toc_content, group_results, physical_ranges)
+    else:
+        toc_with_page_number=copy.deepcopy(toc_content)
+        for group_range in group_ranges:
+            group_text = page_range_to_group_text(page_list, group_range, start_index)
+            toc_with_page_number = await add_page_number_to_toc(group_text, toc_with_page_number, model)
     logger.info(f'add_page_number_to_toc: {toc_with_page_number}')
 
     toc_with_page_number = convert_physical_index_to_int(toc_with_page_number)
     logger.info(f'convert_physical_index_to_int: {toc_with_page_number}')
 
+    # titles an earlier mode already confirmed on a page keep that page when this pass missed them
+    for item in toc_with_page_number:
+        if isinstance(item, dict) and item.get('physical_index') is None:
+            confirmed = memo.confirmed_page(item.get('title'))
+            if confirmed is not None and start_index <= confirmed < start_index + len(page_list):
+                item['physical_index'] = confirmed
+
     return toc_with_page_number
 
 
 
-def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=None, model=None, logger=None):
-    toc_with_page_number = toc_transformer(toc_content, model)
+async def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=None, model=None, logger=None, min_local_confidence=None, chunk_tokens=None, match_threshold=None, memo=None):
+    toc_with_page_number = await transform_toc(toc_content, model, min_local_confidence=min_local_confidence, chunk_tokens=chunk_tokens, memo=memo)
     logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
     toc_no_page_number = remove_page_number(copy.deepcopy(toc_with_page_number))
@@ -667,22 +1552,24 @@ def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_che
     for page_index in range(start_page_index, min(start_page_index + toc_check_page_num, len(page_list))):
         main_content += f"<physical_index_{page_index+1}>\n{page_list[page_index][0]}\n<physical_index_{page_index+1}>\n\n"
 
-    toc_with_physical_index = toc_index_extractor(toc_no_page_number, main_content, model)
+    toc_with_physical_index = await toc_index_extractor(toc_no_page_number, main_content, model)
     logger.info(f'toc_with_physical_index: {toc_with_physical_index}')
 
     toc_with_physical_index = convert_physical_index_to_int(toc_with_physical_index)
     logger.info(f'toc_with_physical_index: {toc_with_physical_index}')
 
     matching_pairs = extract_matching_page_pairs(toc_with_page_number, toc_with_physical_index, start_page_index)
+    if match_threshold is not None:
+        matching_pairs.extend(locate_page_pairs(toc_with_page_number, matching_pairs, page_list, start_page_index + 1, match_threshold))
     logger.info(f'matching_pairs: {matching_pairs}')
 
-    offset = calculate_page_offset(matching_pairs)
+    offset = fit_page_offsets(matching_pairs, toc_with_page_number)
     logger.info(f'offset: {offset}')
 
     toc_with_page_number = add_page_offset_to_toc_json(toc_with_page_number, offset)
     logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
-    toc_with_page_number = process_none_page_numbers(toc_with_page_number,page_list, model)
+    toc_with_page_number = await process_none_page_numbers(toc_with_page_number, page_list, model=model, match_threshold=match_threshold)
     logger.info(f'toc_with_page_number: {toc_with_page_number}')
 
     return toc_with_page_number
@@ -690,7 +1577,7 @@ def process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_che
 
 
 ##check if needed to process none page numbers
-def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
+async def process_none_page_numbers(toc_items, page_list, start_index=1, model=None, match_threshold=None):
     for i, item in enumerate(toc_items):
         if "physical_index" not in item:
             # logger.info(f"fix item: {item}")
@@ -708,6 +1595,14 @@ def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
                     next_physical_index = toc_items[j]['physical_index']
                     break
 
+            if match_threshold is not None:
+                last_page = next_physical_index if next_physical_index != -1 else start_index + len(page_list) - 1
+                physical_index = locate_title_in_pages(item['title'], page_list, prev_physical_index, last_page, start_index, match_threshold)
+                if physical_index is not None:
+                    item['physical_index'] = physical_index
+                    item.pop('page', None)
+                    continue
+
             page_contents = []
             for page_index in range(prev_physical_index, next_physical_index+1):
                 page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
@@ -715,7 +1610,7 @@ def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
 
             item_copy = copy.deepcopy(item)
             del item_copy['page']
-            result = add_page_number_to_toc(page_contents, item_copy, model)
+            result = await add_page_number_to_toc(page_contents, item_copy, model)
             if isinstance(result[0]['physical_index'], str) and result[0]['physical_index'].startswith('<physical_index'):
                 item['physical_index'] = int(result[0]['physical_index'].split('_')[-1].rstrip('>').strip())
                 del item['page']
@@ -725,14 +1620,15 @@ def process_none_page_numbers(toc_items, page_list, start_index=1, model=None):
 
 
 
-def check_toc(page_list, opt=None):
-    toc_page_list = find_toc_pages(start_page_index=0, page_list=page_list, opt=opt)
+async def check_toc(page_list, opt=None):
+    detected = {}
+    toc_page_list = await find_toc_pages(start_page_index=0, page_list=page_list, opt=opt, detected=detected)
     if len(toc_page_list) == 0:
         print('no toc found')
         return {'toc_content': None, 'toc_page_list': [], 'page_index_given_in_toc': 'no'}
     else:
         print('toc found')
-        toc_json = toc_extractor(page_list, toc_page_list, opt.model)
+        toc_json = await toc_extractor(page_list, toc_page_list, opt.model)
 
         if toc_json['page_index_given_in_toc'] == 'yes':
             print('index found')
@@ -744,16 +1640,17 @@ def check_toc(page_list, opt=None):
                    current_start_index < len(page_list) and 
                    current_start_index < opt.toc_check_page_num):
                 
-                additional_toc_pages = find_toc_pages(
+                additional_toc_pages = await find_toc_pages(
                     start_page_index=current_start_index,
                     page_list=page_list,
-                    opt=opt
+                    opt=opt,
+                    detected=detected
                 )
                 
                 if len(additional_toc_pages) == 0:
                     break
 
-                additional_toc_json = toc_extractor(page_list, additional_toc_pages, opt.model)
+                additional_toc_json = await toc_extractor(page_list, additional_toc_pages, opt.model)
                 if additional_toc_json['page_index_given_in_toc'] == 'yes':
                     print('index found')
                     return {'toc_content': additional_toc_json['toc_content'], 'toc_page_list': additional_toc_pages, 'page_index_given_in_toc': 'yes'}
@@ -768,8 +1665,71 @@ def check_toc(page_list, opt=None):
 
 
 
+################### pdf outline #########################################################
+def outline_to_toc(outline):
+    # turn (level, title, page_number) bookmarks into the structure/title/physical_index list used by post_processing
+    structures = levels_to_structures([level for level, _, _ in outline])
+    return [
+        {'structure': structure, 'title': title.strip(), 'physical_index': page_number}
+        for structure, (_, title, page_number) in zip(structures, outline)
+    ]
+
+
+def check_outline_structure(toc, num_pages):
+    # cheap sanity check that needs no page text: enough resolvable, in-range, mostly ascending targets
+    if len(toc) < 2:
+        return False
+    pages = [item['physical_index'] for item in toc]
+    valid_pages = [page for page in pages if page is not None and 1 <= page <= num_pages]
+    if len(valid_pages) < 0.9 * len(pages):
+        return False
+    ascending = sum(1 for prev, curr in zip(valid_pages, valid_pages[1:]) if curr >= prev)
+    if ascending < 0.9 * (len(valid_pages) - 1):
+        return False
+    return max(valid_pages) >= num_pages / 2
+
+
+def check_outline_titles(toc, page_list, threshold=0.6):
+    # most bookmark titles should be found on their target page
+    found = 0
+    for item in toc:
+        title = normalize_title_text(item['title'])[:40]
+        if title and title in normalize_title_text(page_list[item['physical_index'] - 1][0]):
+            found += 1
+    return found / len(toc) >= threshold
+
+
+def title_starts_page_locally(title, page_text, head_lines=3):
+    title = normalize_title_text(title)[:40]
+    head = ' '.join([line for line in page_text.splitlines() if line.strip()][:head_lines])
+    return 'yes' if title and title in normalize_title_text(head) else 'no'
+
+
+async def get_outline_toc(doc, page_list, logger=None):
+    """
+    Build the toc straight from the PDF bookmarks when they look trustworthy, otherwise return None.
+    Returns the (possibly completed) page_list alongside, since the title check needs every target page.
+    """
+    toc = outline_to_toc(doc.get_outline())
+    if not check_outline_structure(toc, len(page_list)):
+        if logger:
+            logger.info(f'pdf outline not usable: {len(toc)} entries')
+        return None, page_list
+    if isinstance(page_list, PageStream):
+        page_list = await page_list.result()
+    toc = [item for item in toc if item['physical_index'] is not None and 1 <= item['physical_index'] <= len(page_list)]
+    if not check_outline_titles(toc, page_list):
+        if logger:
+            logger.info('pdf outline titles do not match page text')
+        return None, page_list
+    if logger:
+        logger.info(f'using pdf outline with {len(toc)} entries')
+    return toc, page_list
+
+
+
 ################### fix incorrect toc #########################################################
-def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20"):
+async def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20"):
     tob_extractor_prompt = """
     You are given a section title and several pages of a document, your job is to find the physical index of the start page of the section in the partial document.
 
@@ -783,13 +1743,13 @@ def single_toc_item_index_fixer(section_title, content, model="gpt-4o-2024-11-20
     Directly return the final JSON structure. Do not output anything else."""
 
     prompt = tob_extractor_prompt + '\nSection Title:\n' + str(section_title) + '\nDocument pages:\n' + content
-    response = ChatGPT_API(model=model, prompt=prompt)
+    response = await ChatGPT_API_async(model=model, prompt=prompt)
     json_content = extract_json(response)    
-    return convert_physical_index_to_int(json_content['physical_index'])
+    return convert_physical_index_to_int(json_content.get('physical_index'))
 
 
 
-async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results, start_index=1, model=None, logger=None):
+async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results, start_index=1, model=None, logger=None, match_threshold=None, candidate_pages=None, memo=None):
     print(f'start fix_incorrect_toc with {len(incorrect_results)} incorrect results')
     incorrect_indices = {result['list_index'] for result in incorrect_results}
     
@@ -826,18 +1786,31 @@ async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results,
             'next_correct': next_correct
         })
 
+        physical_index_int = memo.confirmed_page(incorrect_item['title']) if memo is not None else None
+        if physical_index_int is not None and not prev_correct <= physical_index_int <= next_correct:
+            physical_index_int = None
+        if physical_index_int is None and match_threshold is not None:
+            physical_index_int = locate_title_in_pages(incorrect_item['title'], page_list, prev_correct, next_correct, start_index, match_threshold)
+        if physical_index_int is not None:
+            return {
+                'list_index': list_index,
+                'title': incorrect_item['title'],
+                'physical_index': physical_index_int,
+                'is_valid': True
+            }
+
         page_contents=[]
-        for page_index in range(prev_correct, next_correct+1):
+        for page_index in rank_candidate_pages(incorrect_item['title'], page_list, prev_correct, next_correct, start_index, candidate_pages):
             page_text = f"<physical_index_{page_index}>\n{page_list[page_index-start_index][0]}\n<physical_index_{page_index}>\n\n"
             page_contents.append(page_text)
         content_range = ''.join(page_contents)
         
-        physical_index_int = single_toc_item_index_fixer(incorrect_item['title'], content_range, model)
+        physical_index_int = await single_toc_item_index_fixer(incorrect_item['title'], content_range, model)
         
         # Check if the result is correct
         check_item = incorrect_item.copy()
         check_item['physical_index'] = physical_index_int
-        check_result = await check_title_appearance(check_item, page_list, start_index, model)
+        check_result = await check_title_appearance(check_item, page_list, start_index, model, match_threshold=match_threshold)
 
         return {
             'list_index': list_index,
@@ -861,6 +1834,8 @@ async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results,
     # Update the toc_with_page_number with the fixed indices and check for any invalid results
     invalid_results = []
     for result in results:
+        if memo is not None:
+            memo.set_title_check(result['title'], result['physical_index'], 'yes' if result['is_valid'] else 'no')
         if result['is_valid']:
             toc_with_page_number[result['list_index']]['physical_index'] = result['physical_index']
         else:
@@ -877,7 +1852,7 @@ async def fix_incorrect_toc(toc_with_page_number, page_list, incorrect_results,
 
 
 
-async def fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorrect_results, start_index=1, max_attempts=3, model=None, logger=None):
+async def fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorrect_results, start_index=1, max_attempts=3, model=None, logger=None, match_threshold=None, candidate_pages=None, memo=None):
     print('start fix_incorrect_toc')
     fix_attempt = 0
     current_toc = toc_with_page_number
@@ -886,7 +1861,7 @@ async def fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorr
     while current_incorrect:
         print(f"Fixing {len(current_incorrect)} incorrect results")
         
-        current_toc, current_incorrect = await fix_incorrect_toc(current_toc, page_list, current_incorrect, start_index, model, logger)
+        current_toc, current_incorrect = await fix_incorrect_toc(current_toc, page_list, current_incorrect, start_index, model, logger, match_threshold=match_threshold, candidate_pages=candidate_pages, memo=memo)
                 
         fix_attempt += 1
         if fix_attempt >= max_attempts:
@@ -899,7 +1874,31 @@ async def fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorr
 
 
 ################### verify toc #########################################################
-async def verify_toc(page_list, list_result, start_index=1, N=None, model=None):
+# meta_processor fixes a toc verified above this accuracy and falls back to the next mode otherwise
+MIN_TOC_ACCURACY = 0.6
+
+
+def accuracy_interval(correct, checked, population, confidence=0.95):
+    """
+    Wilson interval for the accuracy of a toc of population items when checked of them, sampled
+    without replacement, had correct answers.
+    """
+    if checked == 0:
+        return 0.0, 1.0
+    accuracy = correct / checked
+    if checked >= population:
+        return accuracy, accuracy
+    # finite population correction: every checked item is one less unknown
+    n = checked * (population - 1) / (population - checked)
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    denominator = 1 + z * z / n
+    center = (accuracy + z * z / (2 * n)) / denominator
+    half_width = z * math.sqrt(accuracy * (1 - accuracy) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+async def verify_toc(page_list, list_result, start_index=1, N=None, model=None, batch_tokens=None, match_threshold=None, memo=None,
+                     adaptive=False, batch_size=20, confidence=0.95, on_first_batch=None):
     print('start verify_toc')
     # Find the last non-None physical_index
     last_physical_index = None
@@ -929,12 +1928,62 @@ async def verify_toc(page_list, list_result, start_index=1, N=None, model=None):
         item_with_index['list_index'] = idx  # Add the original index in list_result
         indexed_sample_list.append(item_with_index)
 
-    # Run checks concurrently
-    tasks = [
-        check_title_appearance(item, page_list, start_index, model)
-        for item in indexed_sample_list
-    ]
-    results = await asyncio.gather(*tasks)
+    async def check_items(items):
+        # answers an earlier mode already got for the same title and page are not asked again
+        results = []
+        if memo is not None:
+            pending_list = []
+            for item in items:
+                answer = memo.get_title_check(item['title'], item.get('physical_index'))
+                if answer is None:
+                    pending_list.append(item)
+                else:
+                    results.append({'list_index': item['list_index'], 'answer': answer, 'title': item['title'], 'page_number': item['physical_index']})
+            items = pending_list
+
+        # Run checks concurrently
+        if batch_tokens:
+            checked = await check_title_appearance_batched(items, page_list, start_index, model, max_tokens=batch_tokens, match_threshold=match_threshold)
+        else:
+            tasks = [
+                check_title_appearance(item, page_list, start_index, model, match_threshold=match_threshold)
+                for item in items
+            ]
+            checked = await asyncio.gather(*tasks)
+        if memo is not None:
+            for result in checked:
+                memo.set_title_check(result['title'], result['page_number'], result['answer'])
+        results.extend(checked)
+        return results
+
+    # a passing toc costs one more round when checked in batches, which only pays off when stopping
+    # after the first batch saves most of the checks
+    adaptive = adaptive and len(indexed_sample_list) >= 4 * batch_size
+    if (adaptive or on_first_batch is not None) and N is None and len(indexed_sample_list) > batch_size:
+        # check random batches: on_first_batch gets the accuracy of the first one, and with adaptive the check
+        # goes on until the accuracy is known to be on one side of MIN_TOC_ACCURACY;
+        # a toc that gets fixed or accepted needs every item checked, so only a failing one stops early
+        random.shuffle(indexed_sample_list)
+        results = []
+        position = 0
+        size = batch_size
+        while position < len(indexed_sample_list):
+            results.extend(await check_items(indexed_sample_list[position:position + size]))
+            position += size
+            correct_count = sum(1 for result in results if result['answer'] == 'yes')
+            if on_first_batch is not None and position == batch_size:
+                on_first_batch(correct_count / len(results))
+            if not adaptive:
+                size = len(indexed_sample_list)
+                continue
+            low, high = accuracy_interval(correct_count, len(results), len(indexed_sample_list), confidence)
+            if high <= MIN_TOC_ACCURACY:
+                print(f'stop verify_toc after {len(results)} of {len(indexed_sample_list)} items')
+                break
+            size = len(indexed_sample_list) if low > MIN_TOC_ACCURACY else size * 2
+    else:
+        results = await check_items(indexed_sample_list)
+    results.sort(key=lambda result: result['list_index'])
     
     # Process results
     correct_count = 0
@@ -956,48 +2005,121 @@ async def verify_toc(page_list, list_result, start_index=1, N=None, model=None):
 
 
 ################### main process #########################################################
-async def meta_processor(page_list, mode=None, toc_content=None, toc_page_list=None, start_index=1, opt=None, logger=None):
+async def meta_processor(page_list, mode=None, toc_content=None, toc_page_list=None, start_index=1, opt=None, logger=None, memo=None):
     print(mode)
     print(f'start_index: {start_index}')
+    memo = memo if memo is not None else StageMemo()
+    min_local_confidence = opt.toc_local_parser_min_confidence if opt.toc_local_parser == 'yes' else None
+    match_threshold = opt.title_match_threshold if opt.local_title_match == 'yes' else None
+    group_options = {
+        'group_max_tokens': opt.group_max_tokens,
+        'context_tokens': opt.model_context_tokens or None,
+        'balance_groups': opt.group_balance == 'yes',
+    }
     
     if mode == 'process_toc_with_page_numbers':
-        toc_with_page_number = process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=opt.toc_check_page_num, model=opt.model, logger=logger)
+        toc_with_page_number = await process_toc_with_page_numbers(toc_content, toc_page_list, page_list, toc_check_page_num=opt.toc_check_page_num, model=opt.model, logger=logger, min_local_confidence=min_local_confidence, chunk_tokens=opt.toc_transform_chunk_tokens, match_threshold=match_threshold, memo=memo)
     elif mode == 'process_toc_no_page_numbers':
-        toc_with_page_number = process_toc_no_page_numbers(toc_content, toc_page_list, page_list, model=opt.model, logger=logger)
+        toc_with_page_number = await process_toc_no_page_numbers(toc_content, toc_page_list, page_list, model=opt.model, logger=logger, min_local_confidence=min_local_confidence, chunk_tokens=opt.toc_transform_chunk_tokens, concurrent_groups=opt.toc_concurrent_groups == 'yes', memo=memo, **group_options)
     else:
-        toc_with_page_number = process_no_toc(page_list, start_index=start_index, model=opt.model, logger=logger)
+        toc_with_page_number = await process_no_toc(page_list, start_index=start_index, model=opt.model, logger=logger, map_reduce=opt.no_toc_map_reduce == 'yes', memo=memo, **group_options)
             
     toc_with_page_number = [item for item in toc_with_page_number if item.get('physical_index') is not None] 
-    accuracy, incorrect_results = await verify_toc(page_list, toc_with_page_number, start_index=start_index, model=opt.model)
-        
+    speculative = None
+    on_first_batch = None
+    if opt.race_fallback_modes == 'yes' and mode in FALLBACK_MODES:
+        def on_first_batch(sample_accuracy):
+            # the first verify batch decides whether the next fallback mode starts alongside the rest of the check
+            nonlocal speculative
+            if sample_accuracy < opt.race_trigger_accuracy:
+                speculative = start_speculative_fallback(sample_accuracy, page_list, mode, toc_content, toc_page_list, start_index, opt, logger, memo)
+
+    used_speculative = False
+    try:
+        accuracy, incorrect_results = await verify_toc(page_list, toc_with_page_number, start_index=start_index, model=opt.model, batch_tokens=opt.title_check_batch_tokens, match_threshold=match_threshold, memo=memo,
+                                                       adaptive=opt.verify_adaptive == 'yes', batch_size=opt.verify_batch_size, confidence=opt.verify_confidence, on_first_batch=on_first_batch)
+        if speculative is not None and accuracy > MIN_TOC_ACCURACY:
+            # this mode passed, stop the fallback before fixing rather than after
+            await finish_speculative_fallback(speculative, False, logger)
+            speculative = None
+            
+        logger.info({
+            'mode': 'process_toc_with_page_numbers',
+            'accuracy': accuracy,
+            'incorrect_results': incorrect_results,
+            'stage_memo': memo.stats()
+        })
+        if accuracy == 1.0 and len(incorrect_results) == 0:
+            return toc_with_page_number
+        if accuracy > MIN_TOC_ACCURACY and len(incorrect_results) > 0:
+            toc_with_page_number, incorrect_results = await fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorrect_results,start_index=start_index, max_attempts=3, model=opt.model, logger=logger, match_threshold=match_threshold, candidate_pages=opt.title_candidate_pages, memo=memo)
+            return toc_with_page_number
+        else:
+            if speculative is not None:
+                used_speculative = True
+                return await speculative[0]
+            if mode == 'process_toc_with_page_numbers':
+                return await meta_processor(page_list, mode='process_toc_no_page_numbers', toc_content=toc_content, toc_page_list=toc_page_list, start_index=start_index, opt=opt, logger=logger, memo=memo)
+            elif mode == 'process_toc_no_page_numbers':
+                return await meta_processor(page_list, mode='process_no_toc', start_index=start_index, opt=opt, logger=logger, memo=memo)
+            else:
+                raise Exception('Processing failed')
+    finally:
+        if speculative is not None:
+            await finish_speculative_fallback(speculative, used_speculative, logger)
+
+
+FALLBACK_MODES = {
+    'process_toc_with_page_numbers': 'process_toc_no_page_numbers',
+    'process_toc_no_page_numbers': 'process_no_toc',
+}
+
+
+def start_speculative_fallback(sample_accuracy, page_list, mode, toc_content, toc_page_list, start_index, opt, logger, memo):
+    """
+    Start the next fallback mode right away, so it runs alongside the rest of the verification
+    instead of after it. Returns (task, usage_meter, fallback_mode).
+    """
+    fallback_mode = FALLBACK_MODES[mode]
+    logger.info({'speculative_mode': fallback_mode, 'sample_accuracy': sample_accuracy})
+    if fallback_mode == 'process_toc_no_page_numbers':
+        fallback = meta_processor(page_list, mode=fallback_mode, toc_content=toc_content, toc_page_list=toc_page_list, start_index=start_index, opt=opt, logger=logger, memo=memo)
+    else:
+        fallback = meta_processor(page_list, mode=fallback_mode, start_index=start_index, opt=opt, logger=logger, memo=memo)
+    meter = LLMUsageMeter(parent=llm_usage_meter.get())
+    return asyncio.create_task(run_metered(meter, fallback)), meter, fallback_mode
+
+
+async def finish_speculative_fallback(speculative, used, logger):
+    # cancel a fallback that lost the race and report what it cost
+    task, meter, fallback_mode = speculative
+    if used:
+        return
+    outcome = 'discarded' if task.done() else 'cancelled'
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.info(f'speculative {fallback_mode} failed: {e}')
     logger.info({
-        'mode': 'process_toc_with_page_numbers',
-        'accuracy': accuracy,
-        'incorrect_results': incorrect_results
+        'speculative_mode': fallback_mode,
+        'outcome': outcome,
+        'wasted_tokens': meter.total_tokens,
+        'wasted_usage': meter.stats()
     })
-    if accuracy == 1.0 and len(incorrect_results) == 0:
-        return toc_with_page_number
-    if accuracy > 0.6 and len(incorrect_results) > 0:
-        toc_with_page_number, incorrect_results = await fix_incorrect_toc_with_retries(toc_with_page_number, page_list, incorrect_results,start_index=start_index, max_attempts=3, model=opt.model, logger=logger)
-        return toc_with_page_number
-    else:
-        if mode == 'process_toc_with_page_numbers':
-            return await meta_processor(page_list, mode='process_toc_no_page_numbers', toc_content=toc_content, toc_page_list=toc_page_list, start_index=start_index, opt=opt, logger=logger)
-        elif mode == 'process_toc_no_page_numbers':
-            return await meta_processor(page_list, mode='process_no_toc', start_index=start_index, opt=opt, logger=logger)
-        else:
-            raise Exception('Processing failed')
         
  
-async def process_large_node_recursively(node, page_list, opt=None, logger=None):
+async def process_large_node_recursively(node, page_list, opt=None, logger=None, memo=None):
     node_page_list = page_list[node['start_index']-1:node['end_index']]
     token_num = sum([page[1] for page in node_page_list])
     
     if node['end_index'] - node['start_index'] > opt.max_page_num_each_node and token_num >= opt.max_token_num_each_node:
         print('large node:', node['title'], 'start_index:', node['start_index'], 'end_index:', node['end_index'], 'token_num:', token_num)
 
-        node_toc_tree = await meta_processor(node_page_list, mode='process_no_toc', start_index=node['start_index'], opt=opt, logger=logger)
-        node_toc_tree = await check_title_appearance_in_start_concurrent(node_toc_tree, page_list, model=opt.model, logger=logger)
+        node_toc_tree = await meta_processor(node_page_list, mode='process_no_toc', start_index=node['start_index'], opt=opt, logger=logger, memo=memo)
+        node_toc_tree = await check_title_appearance_in_start_concurrent(node_toc_tree, page_list, model=opt.model, logger=logger, batch_tokens=opt.title_check_batch_tokens)
         
         if node['title'].strip() == node_toc_tree[0]['title'].strip():
             node['nodes'] = post_processing(node_toc_tree[1:], node['end_index'])
@@ -1008,7 +2130,7 @@ async def process_large_node_recursively(node, page_list, opt=None, logger=None)
         
     if 'nodes' in node and node['nodes']:
         tasks = [
-            process_large_node_recursively(child_node, page_list, opt, logger=logger)
+            process_large_node_recursively(child_node, page_list, opt, logger=logger, memo=memo)
             for child_node in node['nodes']
         ]
         await asyncio.gather(*tasks)
@@ -1016,31 +2138,48 @@ async def process_large_node_recursively(node, page_list, opt=None, logger=None)
     return node
 
 async def tree_parser(page_list, opt, doc=None, logger=None):
-    check_toc_result = check_toc(page_list, opt)
-    logger.info(check_toc_result)
-
-    if check_toc_result.get("toc_content") and check_toc_result["toc_content"].strip() and check_toc_result["page_index_given_in_toc"] == "yes":
-        toc_with_page_number = await meta_processor(
-            page_list, 
-            mode='process_toc_with_page_numbers', 
-            start_index=1, 
-            toc_content=check_toc_result['toc_content'], 
-            toc_page_list=check_toc_result['toc_page_list'], 
-            opt=opt,
-            logger=logger)
+    toc_with_page_number = None
+    memo = StageMemo()
+    if opt.use_pdf_outline == 'yes' and isinstance(doc, PDFDocument):
+        toc_with_page_number, page_list = await get_outline_toc(doc, page_list, logger=logger)
+
+    if toc_with_page_number is not None:
+        toc_with_page_number = add_preface_if_needed(toc_with_page_number)
+        # bookmarks give exact targets, only whether the section opens its page is left to decide
+        for item in toc_with_page_number:
+            item['appear_start'] = title_starts_page_locally(item['title'], page_list[item['physical_index'] - 1][0])
     else:
-        toc_with_page_number = await meta_processor(
-            page_list, 
-            mode='process_no_toc', 
-            start_index=1, 
-            opt=opt,
-            logger=logger)
-
-    toc_with_page_number = add_preface_if_needed(toc_with_page_number)
-    toc_with_page_number = await check_title_appearance_in_start_concurrent(toc_with_page_number, page_list, model=opt.model, logger=logger)
+        check_toc_result = await check_toc(page_list, opt)
+        logger.info(check_toc_result)
+        if isinstance(page_list, PageStream):
+            # TOC detection only needs the first pages; everything after it needs the whole document
+            page_list = await page_list.result()
+
+        if check_toc_result.get("toc_content") and check_toc_result["toc_content"].strip() and check_toc_result["page_index_given_in_toc"] == "yes":
+            toc_with_page_number = await meta_processor(
+                page_list, 
+                mode='process_toc_with_page_numbers', 
+                start_index=1, 
+                toc_content=check_toc_result['toc_content'], 
+                toc_page_list=check_toc_result['toc_page_list'], 
+                opt=opt,
+                logger=logger,
+                memo=memo)
+        else:
+            toc_with_page_number = await meta_processor(
+                page_list, 
+                mode='process_no_toc', 
+                start_index=1, 
+                opt=opt,
+                logger=logger,
+                memo=memo)
+
+        toc_with_page_number = add_preface_if_needed(toc_with_page_number)
+        toc_with_page_number = await check_title_appearance_in_start_concurrent(toc_with_page_number, page_list, model=opt.model, logger=logger, batch_tokens=opt.title_check_batch_tokens)
+
     toc_tree = post_processing(toc_with_page_number, len(page_list))
     tasks = [
-        process_large_node_recursively(node, page_list, opt, logger=logger)
+        process_large_node_recursively(node, page_list, opt, logger=logger, memo=memo)
         for node in toc_tree
     ]
     await asyncio.gather(*tasks)
@@ -1049,39 +2188,64 @@ async def tree_parser(page_list, opt, doc=None, logger=None):
 
 
 def page_index_main(doc, opt=None):
+    opt = ConfigLoader().load(opt)
+    # opens the PDF once and raises ValueError for unsupported input
+    doc = doc if isinstance(doc, PDFDocument) else PDFDocument(doc)
     logger = JsonLogger(doc)
-    
-    is_valid_pdf = (
-        (isinstance(doc, str) and os.path.isfile(doc) and doc.lower().endswith(".pdf")) or 
-        isinstance(doc, BytesIO)
-    )
-    if not is_valid_pdf:
-        raise ValueError("Unsupported input type. Expected a PDF file path or BytesIO object.")
+
+    configure_llm_clients(opt)
+    backend = configure_llm_backend(opt)
+    configure_llm_cache(opt)
+    configure_llm_scheduler(opt)
+    configure_llm_retry(opt)
+    configure_token_counter(opt)
+    try:
+        return run_async(page_index_main_async(doc, opt, logger=logger))
+    finally:
+        logger.info({'llm_cache': llm_cache.stats(), 'llm_scheduler': llm_scheduler.stats()})
+        if isinstance(backend, ReplayBackend):
+            logger.info({'llm_replay': backend.stats()})
+        close_llm_clients()
+        llm_cache.close()
+
+
+async def page_index_main_async(doc, opt=None, logger=None):
+    opt = ConfigLoader().load(opt)
+    doc = doc if isinstance(doc, PDFDocument) else PDFDocument(doc)
+    if logger is None:
+        logger = JsonLogger(doc)
 
     print('Parsing PDF...')
-    page_list = get_page_tokens(doc)
+    page_cache_dir = opt.page_cache_dir if opt.page_cache == 'yes' else None
+    if opt.page_streaming == 'yes':
+        page_stream = PageStream(doc, model=opt.model, workers=opt.pdf_parse_workers, cache_dir=page_cache_dir,
+                                 head_pages=opt.toc_check_page_num).start()
+        structure = await tree_parser(page_stream, opt, doc=doc, logger=logger)
+        page_list = await page_stream.result()
+    else:
+        page_list = doc.get_page_tokens(model=opt.model, workers=opt.pdf_parse_workers, cache_dir=page_cache_dir)
+        structure = await tree_parser(page_list, opt, doc=doc, logger=logger)
 
     logger.info({'total_page_number': len(page_list)})
     logger.info({'total_token': sum([page[1] for page in page_list])})
     
-    structure = asyncio.run(tree_parser(page_list, opt, doc=doc, logger=logger))
     if opt.if_add_node_id == 'yes':
         write_node_id(structure)    
     if opt.if_add_node_summary == 'yes':
         add_node_text(structure, page_list)
-        asyncio.run(generate_summaries_for_structure(structure, model=opt.model))
+        await generate_summaries_for_structure(structure, model=opt.model)
         remove_structure_text(structure)
         if opt.if_add_node_text == 'yes':
             add_node_text_with_labels(structure, page_list)
         if opt.if_add_doc_description == 'yes':
-            doc_description = generate_doc_description(structure, model=opt.model)
+            doc_description = await generate_doc_description(structure, model=opt.model)
             return {
-                'doc_name': get_pdf_name(doc),
+                'doc_name': doc.name,
                 'doc_description': doc_description,
                 'structure': structure,
             }
     return {
-        'doc_name': get_pdf_name(doc),
+        'doc_name': doc.name,
         'structure': structure,
     }
 
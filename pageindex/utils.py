@@ -2,12 +2,32 @@ import tiktoken
 import openai
 import logging
 import os
+import re
+import functools
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import time
 import json
 import PyPDF2
 import copy
 import asyncio
+import math
+import threading
+import contextvars
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import hashlib
+import random
+import sqlite3
+import struct
+import mmap
+import bisect
+from array import array
+from collections import Counter
+import tempfile
+import httpx
+from contextlib import contextmanager, asynccontextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import pymupdf
 from io import BytesIO
 from dotenv import load_dotenv
@@ -16,13 +36,31 @@ import logging
 import yaml
 from pathlib import Path
 from types import SimpleNamespace as config
+from types import SimpleNamespace
 from typing import Optional, List, Tuple
 
 CHATGPT_API_KEY = os.getenv("CHATGPT_API_KEY", "")
 CHATGPT_BASE_URL = os.getenv("CHATGPT_BASE_URL", "https://api.openai.com/v1")
 
 
-def count_tokens(text, model=None):
+DEFAULT_TOKENIZER_MODEL = "gpt-4o-2024-11-20"
+# 非OpenAI模型（如deepseek-chat）tiktoken无法识别，退回到该编码
+FALLBACK_ENCODING = "o200k_base"
+CJK_PATTERN = re.compile('[\u4e00-\u9fff]')
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model=None):
+    """
+    返回模型对应的tiktoken编码，进程内缓存
+    """
+    try:
+        return tiktoken.encoding_for_model(model or DEFAULT_TOKENIZER_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding(FALLBACK_ENCODING)
+
+
+def approx_count_tokens(text):
     """
     使用简单的字符计数方法估算token数量
     中文每个字按1个token计算
@@ -30,16 +68,976 @@ def count_tokens(text, model=None):
     """
     if not text:
         return 0
-        
-    # 分离中文和非中文字符
-    chinese_chars = sum(1 for c in text if '\u4e00' <= c <= '\u9fff')
+    # 用正则在C层面统计中文字符，避免逐字符的Python循环
+    chinese_chars = len(text) - len(CJK_PATTERN.sub('', text))
     other_chars = len(text) - chinese_chars
-    
-    # 估算token数:
-    # 中文字符每个算1个token
-    # 其他字符每4个算1个token
-    estimated_tokens = chinese_chars + (other_chars + 3) // 4
-    return estimated_tokens
+    return chinese_chars + (other_chars + 3) // 4
+
+
+class TokenCounter:
+    """
+    统一的token计数：mode为approx时用字符估算，为tiktoken时用模型真实的分词器
+    """
+    def __init__(self, mode="approx", num_threads=8):
+        self.mode = mode
+        self.num_threads = num_threads
+
+    def configure(self, mode=None, num_threads=None):
+        if mode is not None:
+            if mode not in ("approx", "tiktoken"):
+                raise ValueError(f"Unsupported token counter: {mode}")
+            self.mode = mode
+        if num_threads is not None:
+            self.num_threads = num_threads
+
+    def count(self, text, model=None):
+        if not text:
+            return 0
+        if self.mode == "tiktoken":
+            return len(get_encoding(model).encode_ordinary(text))
+        return approx_count_tokens(text)
+
+    def count_batch(self, texts, model=None):
+        if self.mode == "tiktoken":
+            return encode_token_lengths(texts, model, self.num_threads)
+        return [approx_count_tokens(text) for text in texts]
+
+
+def encode_token_lengths(texts, model=None, num_threads=8):
+    """
+    用tiktoken多线程批量编码，返回每段文本的token数
+    """
+    encoded = get_encoding(model).encode_ordinary_batch(list(texts), num_threads=num_threads)
+    return [len(tokens) for tokens in encoded]
+
+
+token_counter = TokenCounter()
+
+
+def configure_token_counter(opt):
+    token_counter.configure(mode=opt.token_counter)
+
+
+def count_tokens(text, model=None):
+    return token_counter.count(text, model)
+
+
+def count_tokens_batch(texts, model=None):
+    return token_counter.count_batch(texts, model)
+
+
+class LLMClientManager:
+    """
+    进程级共享的OpenAI客户端管理器
+    同步客户端在进程内复用，异步客户端按事件循环复用，底层httpx连接池保持keep-alive
+    SDK自带的重试被关闭，重试统一由LLMRetryPolicy处理
+    """
+    def __init__(self, max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=600.0):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._async_clients = {}
+
+    def configure(self, max_connections=None, max_keepalive_connections=None, keepalive_expiry=None, timeout=None):
+        """
+        更新连接池配置，已创建的客户端会被关闭，下次调用时按新配置重建
+        """
+        with self._lock:
+            if max_connections is not None:
+                self.max_connections = max_connections
+            if max_keepalive_connections is not None:
+                self.max_keepalive_connections = max_keepalive_connections
+            if keepalive_expiry is not None:
+                self.keepalive_expiry = keepalive_expiry
+            if timeout is not None:
+                self.timeout = timeout
+        self.close()
+
+    def _limits(self):
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    @staticmethod
+    def _resolve(api_key, base_url):
+        # 运行时读取环境变量，允许在导入之后再设置CHATGPT_API_KEY/CHATGPT_BASE_URL
+        api_key = api_key or os.getenv("CHATGPT_API_KEY", CHATGPT_API_KEY)
+        base_url = base_url or os.getenv("CHATGPT_BASE_URL", CHATGPT_BASE_URL)
+        return api_key, base_url
+
+    def get_client(self, api_key=None, base_url=None) -> openai.OpenAI:
+        api_key, base_url = self._resolve(api_key, base_url)
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = openai.OpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=self.timeout,
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(limits=self._limits(), timeout=self.timeout),
+                )
+                self._clients[key] = client
+            return client
+
+    def get_async_client(self, api_key=None, base_url=None) -> openai.AsyncOpenAI:
+        # httpx的异步连接绑定在创建它的事件循环上，因此按事件循环区分
+        api_key, base_url = self._resolve(api_key, base_url)
+        key = (api_key, base_url, id(asyncio.get_running_loop()))
+        with self._lock:
+            client = self._async_clients.get(key)
+            if client is None:
+                client = openai.AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=self.timeout,
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(limits=self._limits(), timeout=self.timeout),
+                )
+                self._async_clients[key] = client
+            return client
+
+    async def aclose(self):
+        """
+        关闭当前事件循环上的异步客户端，需要在事件循环结束前调用
+        """
+        loop_id = id(asyncio.get_running_loop())
+        with self._lock:
+            keys = [key for key in self._async_clients if key[2] == loop_id]
+            clients = [self._async_clients.pop(key) for key in keys]
+        for client in clients:
+            try:
+                await client.close()
+            except Exception as e:
+                logging.warning(f"关闭异步客户端失败: {str(e)}")
+
+    def close(self):
+        """
+        关闭所有同步客户端；其他事件循环上遗留的异步客户端直接丢弃
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._async_clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logging.warning(f"关闭客户端失败: {str(e)}")
+
+
+llm_clients = LLMClientManager()
+
+
+def configure_llm_clients(opt):
+    llm_clients.configure(
+        max_connections=opt.llm_max_connections,
+        max_keepalive_connections=opt.llm_max_keepalive_connections,
+        timeout=opt.llm_timeout,
+    )
+
+
+def run_async(coro):
+    """
+    在新的事件循环中运行协程，并在循环关闭前释放该循环上的异步客户端
+    """
+    async def runner():
+        try:
+            return await coro
+        finally:
+            await llm_clients.aclose()
+    return asyncio.run(runner())
+
+
+def close_llm_clients():
+    llm_clients.close()
+
+
+class LLMResponseCache:
+    """
+    基于SQLite的LLM响应缓存
+    以 模型 + 完整消息列表 + 采样参数 的哈希为键，按条目大小和存活时间做LRU淘汰
+    """
+    def __init__(self, path="./cache/llm_cache.sqlite", enabled=True, max_size_mb=1024, max_age_days=30, evict_every=200):
+        self.path = path
+        self.enabled = enabled
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 86400
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        # 命中时只记在内存里，淘汰或关闭时再批量写回last_access，命中路径不写磁盘
+        self._pending_access = {}
+
+    def configure(self, path=None, enabled=None, max_size_mb=None, max_age_days=None):
+        self.close()
+        with self._lock:
+            self.hits = self.misses = self.writes = self.evictions = 0
+            if path is not None:
+                self.path = path
+            if enabled is not None:
+                self.enabled = enabled
+            if max_size_mb is not None:
+                self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+            if max_age_days is not None:
+                self.max_age_seconds = max_age_days * 86400
+
+    @staticmethod
+    def make_key(model, messages, params):
+        payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        # 调用方需持有self._lock
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, finish_reason TEXT, "
+                "size INTEGER, created REAL, last_access REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON responses(last_access)")
+            self._evict()
+        return self._conn
+
+    def get(self, model, messages, params):
+        """
+        返回缓存的 (response, finish_reason)，未命中返回None
+        """
+        if not self.enabled:
+            return None
+        key = self.make_key(model, messages, params)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT response, finish_reason, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None or now - row[2] > self.max_age_seconds:
+                    self.misses += 1
+                    return None
+                self._pending_access[key] = now
+                self.hits += 1
+                return row[0], row[1]
+        except sqlite3.Error as e:
+            logging.warning(f"读取LLM缓存失败: {str(e)}")
+            return None
+
+    def put(self, model, messages, params, response, finish_reason):
+        if not self.enabled or response is None:
+            return
+        key = self.make_key(model, messages, params)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, model, response, finish_reason, len(response.encode("utf-8")), now, now),
+                )
+                conn.commit()
+                self.writes += 1
+                if self.writes % self.evict_every == 0:
+                    self._evict()
+        except sqlite3.Error as e:
+            logging.warning(f"写入LLM缓存失败: {str(e)}")
+
+    def _flush_access(self):
+        # 调用方需持有self._lock
+        if self._pending_access:
+            self._conn.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(last_access, key) for key, last_access in self._pending_access.items()],
+            )
+            self._pending_access = {}
+
+    def _evict(self):
+        # 调用方需持有self._lock
+        conn = self._conn
+        self._flush_access()
+        cursor = conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_seconds,))
+        self.evictions += max(cursor.rowcount, 0)
+        total_size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size > self.max_size_bytes:
+            stale_keys = []
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                if total_size <= self.max_size_bytes:
+                    break
+                stale_keys.append((key,))
+                total_size -= size
+            conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+            self.evictions += len(stale_keys)
+        conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'writes': self.writes,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._flush_access()
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    logging.warning(f"写回LLM缓存访问时间失败: {str(e)}")
+                self._conn.close()
+                self._conn = None
+            self._pending_access = {}
+
+
+llm_cache = LLMResponseCache()
+
+
+def configure_llm_cache(opt):
+    # 录制和回放需要每个请求都到达后端
+    llm_cache.configure(
+        path=opt.llm_cache_path,
+        enabled=opt.llm_cache == 'yes' and opt.llm_backend == 'openai',
+        max_size_mb=opt.llm_cache_max_size_mb,
+        max_age_days=opt.llm_cache_max_age_days,
+    )
+
+
+class TokenBucket:
+    """
+    线程安全的令牌桶，配额按每分钟计
+    允许透支：预留超出余量的部分转换为调用方需要等待的秒数，从而平滑地排队
+    """
+    def __init__(self, per_minute=0):
+        self._lock = threading.Lock()
+        self.configure(per_minute)
+
+    def configure(self, per_minute):
+        self.capacity = per_minute or 0
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        """
+        预留amount个令牌，返回需要等待的秒数；capacity为0表示不限速
+        """
+        if not self.capacity:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 单次请求超过桶容量时按满桶计，否则永远无法放行
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount):
+        if not self.capacity or amount <= 0:
+            return
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ConcurrencyGate:
+    """
+    同时限制同步线程和任意事件循环中协程的在途请求数，上限可在运行时调整
+    """
+    def __init__(self, limit=16):
+        self.limit = limit
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []
+
+    def _try_acquire(self):
+        # 调用方需持有self._cond
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+        return False
+
+    def _wake_all(self):
+        # 调用方需持有self._cond；被唤醒的等待者会重新竞争
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def set_limit(self, limit):
+        with self._cond:
+            self.limit = max(1, limit)
+            self._wake_all()
+
+    def acquire(self):
+        with self._cond:
+            while not self._try_acquire():
+                self._cond.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._try_acquire():
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            await future
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._wake_all()
+
+
+class LLMScheduler:
+    """
+    全局LLM请求调度器：在途请求数上限 + 每分钟请求数/token数令牌桶
+    所有ChatGPT_API*调用都经过这里，asyncio.gather大量并发时也不会超出服务商限额
+    开启adaptive时按AIMD调整在途上限：被限流时乘性减半，连续成功一轮后加一
+    """
+    def __init__(self, max_in_flight=16, requests_per_minute=0, tokens_per_minute=0,
+                 adaptive=True, min_in_flight=1, decrease_factor=0.5, decrease_cooldown=2.0):
+        self.gate = ConcurrencyGate(max_in_flight)
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.adaptive = adaptive
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self._aimd_lock = threading.Lock()
+        self._successes = 0
+        self._last_decrease = 0.0
+        self.requests = 0
+        self.throttled_seconds = 0.0
+        self.throttle_events = 0
+
+    def configure(self, max_in_flight=None, requests_per_minute=None, tokens_per_minute=None,
+                  adaptive=None, min_in_flight=None):
+        if max_in_flight is not None:
+            self.max_in_flight = max_in_flight
+            self.gate.set_limit(max_in_flight)
+        if requests_per_minute is not None:
+            self.request_bucket.configure(requests_per_minute)
+        if tokens_per_minute is not None:
+            self.token_bucket.configure(tokens_per_minute)
+        if adaptive is not None:
+            self.adaptive = adaptive
+        if min_in_flight is not None:
+            self.min_in_flight = min(min_in_flight, self.max_in_flight)
+        self.gate.peak_in_flight = 0
+        self._successes = 0
+        self.requests = 0
+        self.throttled_seconds = 0.0
+        self.throttle_events = 0
+
+    def on_success(self):
+        if not self.adaptive:
+            return
+        with self._aimd_lock:
+            self._successes += 1
+            # 加性增：每完成一个"窗口"（当前上限个请求）上限加一
+            if self._successes >= self.gate.limit and self.gate.limit < self.max_in_flight:
+                self._successes = 0
+                self.gate.set_limit(self.gate.limit + 1)
+
+    def on_throttle(self):
+        self.throttle_events += 1
+        if not self.adaptive:
+            return
+        with self._aimd_lock:
+            self._successes = 0
+            # 同一波并发往往同时收到429，冷却期内只减一次
+            now = time.monotonic()
+            if now - self._last_decrease < self.decrease_cooldown:
+                return
+            self._last_decrease = now
+            new_limit = max(self.min_in_flight, int(self.gate.limit * self.decrease_factor))
+            if new_limit < self.gate.limit:
+                logging.warning(f"触发限流，并发上限由{self.gate.limit}降至{new_limit}")
+                self.gate.set_limit(new_limit)
+
+    def _reserve(self, estimated_tokens):
+        self.requests += 1
+        wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimated_tokens))
+        self.throttled_seconds += wait
+        return wait
+
+    @contextmanager
+    def slot(self, estimated_tokens=0):
+        self.gate.acquire()
+        try:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            yield
+        finally:
+            self.gate.release()
+
+    @asynccontextmanager
+    async def aslot(self, estimated_tokens=0):
+        await self.gate.acquire_async()
+        try:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            self.gate.release()
+
+    def record_usage(self, estimated_tokens, completion):
+        """
+        用响应中的实际用量修正预估，退还多预留的token
+        """
+        usage = getattr(completion, 'usage', None)
+        if usage is not None and getattr(usage, 'total_tokens', None) is not None:
+            self.token_bucket.refund(estimated_tokens - usage.total_tokens)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'peak_in_flight': self.gate.peak_in_flight,
+            'in_flight_limit': self.gate.limit,
+            'throttled_seconds': round(self.throttled_seconds, 2),
+            'throttle_events': self.throttle_events,
+        }
+
+
+llm_scheduler = LLMScheduler()
+
+
+class LLMUsageMeter:
+    """
+    统计一段异步任务内LLM调用实际消耗的token，通过contextvars随任务及其子任务传递；嵌套的计量同时计入外层
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, completion):
+        usage = getattr(completion, 'usage', None)
+        self.requests += 1
+        self.prompt_tokens += getattr(usage, 'prompt_tokens', 0) or 0
+        self.completion_tokens += getattr(usage, 'completion_tokens', 0) or 0
+        if self.parent is not None:
+            self.parent.add(completion)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+
+
+llm_usage_meter = contextvars.ContextVar('llm_usage_meter', default=None)
+
+
+async def run_metered(meter, coro):
+    # run coro with its LLM usage counted on meter; meant to be wrapped in its own task
+    token = llm_usage_meter.set(meter)
+    try:
+        return await coro
+    finally:
+        llm_usage_meter.reset(token)
+
+
+def record_metered_usage(completion):
+    meter = llm_usage_meter.get()
+    if meter is not None:
+        meter.add(completion)
+
+
+def configure_llm_scheduler(opt):
+    llm_scheduler.configure(
+        max_in_flight=opt.llm_max_in_flight,
+        requests_per_minute=opt.llm_requests_per_minute,
+        tokens_per_minute=opt.llm_tokens_per_minute,
+        adaptive=opt.llm_adaptive_concurrency == 'yes',
+        min_in_flight=opt.llm_min_in_flight,
+    )
+
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMRetryPolicy:
+    """
+    LLM调用的分类重试：429、5xx、超时和连接错误按带抖动的指数退避重试，并遵守Retry-After
+    """
+    def __init__(self, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def configure(self, max_retries=None, base_delay=None, max_delay=None):
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if base_delay is not None:
+            self.base_delay = base_delay
+        if max_delay is not None:
+            self.max_delay = max_delay
+
+    @staticmethod
+    def _retry_after(error):
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        value = headers.get('retry-after-ms')
+        if value:
+            try:
+                return float(value) / 1000
+            except ValueError:
+                pass
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def classify(cls, error):
+        """
+        返回 (是否可重试, 是否为限流, Retry-After秒数)
+        """
+        if isinstance(error, SimulatedLLMError):
+            return error.status_code in RETRYABLE_STATUS_CODES, error.status_code == 429, error.retry_after
+        if isinstance(error, openai.RateLimitError):
+            # 额度耗尽同样返回429，但重试没有意义
+            if getattr(error, 'code', None) == 'insufficient_quota':
+                return False, False, None
+            return True, True, cls._retry_after(error)
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True, False, None
+        if isinstance(error, openai.APIStatusError):
+            return error.status_code in RETRYABLE_STATUS_CODES, error.status_code == 429, cls._retry_after(error)
+        return False, False, None
+
+    def next_delay(self, error, attempt):
+        """
+        记录一次失败，返回下次重试前的等待秒数；不再重试时返回None
+        """
+        retryable, throttled, retry_after = self.classify(error)
+        if throttled:
+            llm_scheduler.on_throttle()
+        if not retryable or attempt >= self.max_retries:
+            return None
+        # full jitter
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+
+llm_retry = LLMRetryPolicy()
+
+
+def configure_llm_retry(opt):
+    llm_retry.configure(
+        max_retries=opt.llm_max_retries,
+        base_delay=opt.llm_retry_base_delay,
+        max_delay=opt.llm_retry_max_delay,
+    )
+
+
+def estimate_request_tokens(messages, params):
+    # 服务商按 输入token + max_tokens 计入TPM
+    prompt_tokens = sum(approx_count_tokens(message.get('content')) for message in messages)
+    return prompt_tokens + params.get('max_tokens', 0)
+
+
+class SimulatedLLMError(Exception):
+    """
+    回放后端注入的模拟错误，按HTTP状态码参与重试分类
+    """
+    def __init__(self, status_code, retry_after=None):
+        super().__init__(f"simulated LLM error {status_code}")
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def make_completion(content, finish_reason, usage=None):
+    """
+    构造与OpenAI ChatCompletion结构相同的对象
+    """
+    usage = usage or {}
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content), finish_reason=finish_reason)],
+        usage=SimpleNamespace(
+            prompt_tokens=usage.get('prompt_tokens'),
+            completion_tokens=usage.get('completion_tokens'),
+            total_tokens=usage.get('total_tokens'),
+        ) if usage else None,
+    )
+
+
+class OpenAIBackend:
+    """
+    默认后端：通过共享客户端调用OpenAI兼容接口
+    """
+    def complete(self, model, messages, params, api_key=None):
+        client = llm_clients.get_client(api_key)
+        return client.chat.completions.create(model=model, messages=messages, **params)
+
+    async def acomplete(self, model, messages, params, api_key=None):
+        client = llm_clients.get_async_client(api_key)
+        return await client.chat.completions.create(model=model, messages=messages, **params)
+
+
+class RecordingBackend:
+    """
+    透传到内层后端，并把每一对请求/响应追加写入cassette文件（JSON Lines）
+    """
+    def __init__(self, cassette_path, inner=None):
+        self.cassette_path = cassette_path
+        self.inner = inner or OpenAIBackend()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(cassette_path)), exist_ok=True)
+
+    def _record(self, model, messages, params, completion):
+        usage = getattr(completion, 'usage', None)
+        entry = {
+            'key': LLMResponseCache.make_key(model, messages, params),
+            'model': model,
+            'messages': messages,
+            'params': params,
+            'response': completion.choices[0].message.content,
+            'finish_reason': completion.choices[0].finish_reason,
+            'usage': {
+                'prompt_tokens': getattr(usage, 'prompt_tokens', None),
+                'completion_tokens': getattr(usage, 'completion_tokens', None),
+                'total_tokens': getattr(usage, 'total_tokens', None),
+            } if usage is not None else None,
+        }
+        with self._lock:
+            with open(self.cassette_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def complete(self, model, messages, params, api_key=None):
+        completion = self.inner.complete(model, messages, params, api_key)
+        self._record(model, messages, params, completion)
+        return completion
+
+    async def acomplete(self, model, messages, params, api_key=None):
+        completion = await self.inner.acomplete(model, messages, params, api_key)
+        self._record(model, messages, params, completion)
+        return completion
+
+
+class ReplayBackend:
+    """
+    从cassette文件回放响应，不访问网络
+    latency为每次请求的固定延迟（秒），tokens_per_second按输出token数模拟生成耗时，
+    error_rate为注入模拟错误（error_status_codes中随机选取）的概率，seed固定后结果可复现
+    """
+    def __init__(self, cassette_path, latency=0.0, tokens_per_second=0, error_rate=0.0,
+                 error_status_codes=(429, 500, 503), seed=None):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status_codes = tuple(error_status_codes)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.entries = {}
+        with open(cassette_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[entry['key']] = entry
+        self.replayed = 0
+        self.misses = 0
+        self.injected_errors = 0
+
+    def _lookup(self, model, messages, params):
+        with self._lock:
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.injected_errors += 1
+                status_code = self._random.choice(self.error_status_codes)
+                raise SimulatedLLMError(status_code, retry_after=1.0 if status_code == 429 else None)
+            entry = self.entries.get(LLMResponseCache.make_key(model, messages, params))
+            if entry is None:
+                self.misses += 1
+                raise LookupError(f"no recorded response for this request (model={model})")
+            self.replayed += 1
+        usage = entry.get('usage') or {}
+        delay = self.latency
+        if self.tokens_per_second:
+            completion_tokens = usage.get('completion_tokens') or approx_count_tokens(entry['response'])
+            delay += completion_tokens / self.tokens_per_second
+        return make_completion(entry['response'], entry['finish_reason'], usage), delay
+
+    def complete(self, model, messages, params, api_key=None):
+        completion, delay = self._lookup(model, messages, params)
+        if delay > 0:
+            time.sleep(delay)
+        return completion
+
+    async def acomplete(self, model, messages, params, api_key=None):
+        completion, delay = self._lookup(model, messages, params)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return completion
+
+    def stats(self):
+        return {
+            'replayed': self.replayed,
+            'misses': self.misses,
+            'injected_errors': self.injected_errors,
+        }
+
+
+llm_backend = OpenAIBackend()
+
+
+def configure_llm_backend(opt):
+    global llm_backend
+    if opt.llm_backend == 'openai':
+        llm_backend = OpenAIBackend()
+    elif opt.llm_backend == 'record':
+        llm_backend = RecordingBackend(opt.llm_cassette_path)
+    elif opt.llm_backend == 'replay':
+        llm_backend = ReplayBackend(
+            opt.llm_cassette_path,
+            latency=opt.llm_replay_latency,
+            tokens_per_second=opt.llm_replay_tokens_per_second,
+            error_rate=opt.llm_replay_error_rate,
+            seed=opt.llm_replay_seed,
+        )
+    else:
+        raise ValueError(f"Unsupported LLM backend: {opt.llm_backend}")
+    return llm_backend
+
+
+def serve_llm_backend(backend, host="127.0.0.1", port=8000):
+    """
+    以OpenAI兼容的 /v1/chat/completions 接口对外提供backend（通常是ReplayBackend），
+    把CHATGPT_BASE_URL指向 http://host:port/v1 即可让真实客户端、连接池和重试逻辑走本地替身服务
+    返回已在后台线程启动的server，调用server.shutdown()停止
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload, headers=None):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send_json(404, {'error': {'message': f'unknown path {self.path}'}})
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            params = {name: request[name] for name in LLM_SAMPLING_PARAMS if name in request}
+            try:
+                completion = backend.complete(request.get('model'), request.get('messages', []), params)
+            except SimulatedLLMError as e:
+                headers = {'Retry-After': str(e.retry_after)} if e.retry_after is not None else None
+                self._send_json(e.status_code, {'error': {'message': str(e), 'type': 'simulated'}}, headers)
+                return
+            except LookupError as e:
+                self._send_json(404, {'error': {'message': str(e)}})
+                return
+            usage = completion.usage
+            self._send_json(200, {
+                'id': 'chatcmpl-replay',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model'),
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': completion.choices[0].message.content},
+                    'finish_reason': completion.choices[0].finish_reason,
+                }],
+                'usage': {
+                    'prompt_tokens': usage.prompt_tokens or 0,
+                    'completion_tokens': usage.completion_tokens or 0,
+                    'total_tokens': usage.total_tokens or 0,
+                } if usage is not None else None,
+            })
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+LLM_SAMPLING_PARAMS = {"temperature": 0.1, "max_tokens": 4000}
+
+# 常见模型的上下文窗口（token），按模型名前缀匹配，未列出的模型按 DEFAULT_CONTEXT_WINDOW 处理
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4.1": 1047576,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o3": 200000,
+    "o4-mini": 200000,
+    "deepseek": 64000,
+}
+DEFAULT_CONTEXT_WINDOW = 32000
+
+
+def get_model_context_window(model):
+    for prefix in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model and model.startswith(prefix):
+            return MODEL_CONTEXT_WINDOWS[prefix]
+    return DEFAULT_CONTEXT_WINDOW
+
+
+def group_token_budget(model, prompt_tokens=0, output_tokens=None, context_tokens=None, safety_margin=0.9, input_per_output_token=None):
+    """
+    Tokens of document text that fit in one request next to the prompt and the expected answer.
+    context_tokens overrides the window known for the model.
+    When the answer grows with the group (a list of every heading in it), input_per_output_token also
+    caps the group at what output_tokens can describe: 5 gives the 20000 tokens known to work with 4000.
+    """
+    context_tokens = context_tokens or get_model_context_window(model)
+    if output_tokens is None:
+        output_tokens = LLM_SAMPLING_PARAMS["max_tokens"]
+    budget = int((context_tokens - output_tokens - prompt_tokens) * safety_margin)
+    if input_per_output_token:
+        budget = min(budget, output_tokens * input_per_output_token)
+    return max(1000, budget)
+
 
 def ChatGPT_API_with_finish_reason(
     model: str, 
@@ -50,30 +1048,38 @@ def ChatGPT_API_with_finish_reason(
     """
     调用ChatGPT API并返回响应和finish_reason
     """
-    try:
-        client = openai.OpenAI(api_key=api_key, base_url=CHATGPT_BASE_URL)
-        messages = []
-        
-        if chat_history:
-            messages.extend(chat_history)
-            
-        messages.append({"role": "user", "content": prompt})
-        
-        completion = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            temperature=0.1,
-            max_tokens=4000,
-        )
-        
-        response = completion.choices[0].message.content
-        finish_reason = completion.choices[0].finish_reason
-        
-        return response, finish_reason
-        
-    except Exception as e:
-        logging.error(f"API调用错误: {str(e)}")
-        return None, "error"
+    messages = []
+    if chat_history:
+        messages.extend(chat_history)
+    messages.append({"role": "user", "content": prompt})
+
+    cached = llm_cache.get(model, messages, LLM_SAMPLING_PARAMS)
+    if cached is not None:
+        return cached
+
+    estimated_tokens = estimate_request_tokens(messages, LLM_SAMPLING_PARAMS)
+    attempt = 0
+    while True:
+        try:
+            with llm_scheduler.slot(estimated_tokens):
+                completion = llm_backend.complete(model, messages, LLM_SAMPLING_PARAMS, api_key)
+            break
+        except Exception as e:
+            delay = llm_retry.next_delay(e, attempt)
+            if delay is None:
+                logging.error(f"API调用错误: {str(e)}")
+                return None, "error"
+            attempt += 1
+            logging.warning(f"API调用失败，{delay:.1f}秒后进行第{attempt}次重试: {str(e)}")
+            time.sleep(delay)
+
+    llm_scheduler.on_success()
+    llm_scheduler.record_usage(estimated_tokens, completion)
+    record_metered_usage(completion)
+    response = completion.choices[0].message.content
+    finish_reason = completion.choices[0].finish_reason
+    llm_cache.put(model, messages, LLM_SAMPLING_PARAMS, response, finish_reason)
+    return response, finish_reason
 
 def ChatGPT_API(
     model: str, 
@@ -87,29 +1093,59 @@ def ChatGPT_API(
     response, _ = ChatGPT_API_with_finish_reason(model, prompt, api_key, chat_history)
     return response
 
+async def ChatGPT_API_with_finish_reason_async(
+    model: str, 
+    prompt: str, 
+    api_key: str = CHATGPT_API_KEY, 
+    chat_history: Optional[List[dict]] = None
+) -> Tuple[Optional[str], str]:
+    """
+    异步调用ChatGPT API并返回响应和finish_reason
+    """
+    messages = []
+    if chat_history:
+        messages.extend(chat_history)
+    messages.append({"role": "user", "content": prompt})
+
+    cached = llm_cache.get(model, messages, LLM_SAMPLING_PARAMS)
+    if cached is not None:
+        return cached
+
+    estimated_tokens = estimate_request_tokens(messages, LLM_SAMPLING_PARAMS)
+    attempt = 0
+    while True:
+        try:
+            async with llm_scheduler.aslot(estimated_tokens):
+                completion = await llm_backend.acomplete(model, messages, LLM_SAMPLING_PARAMS, api_key)
+            break
+        except Exception as e:
+            delay = llm_retry.next_delay(e, attempt)
+            if delay is None:
+                logging.error(f"异步API调用错误: {str(e)}")
+                return None, "error"
+            attempt += 1
+            logging.warning(f"异步API调用失败，{delay:.1f}秒后进行第{attempt}次重试: {str(e)}")
+            await asyncio.sleep(delay)
+
+    llm_scheduler.on_success()
+    llm_scheduler.record_usage(estimated_tokens, completion)
+    record_metered_usage(completion)
+    response = completion.choices[0].message.content
+    finish_reason = completion.choices[0].finish_reason
+    llm_cache.put(model, messages, LLM_SAMPLING_PARAMS, response, finish_reason)
+    return response, finish_reason
+
 async def ChatGPT_API_async(
     model: str, 
     prompt: str, 
-    api_key: str = CHATGPT_API_KEY
+    api_key: str = CHATGPT_API_KEY, 
+    chat_history: Optional[List[dict]] = None
 ) -> Optional[str]:
     """
     异步调用ChatGPT API
     """
-    try:
-        client = openai.AsyncOpenAI(api_key=api_key, base_url=CHATGPT_BASE_URL)
-        
-        completion = await client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-            max_tokens=4000,
-        )
-        
-        return completion.choices[0].message.content
-        
-    except Exception as e:
-        logging.error(f"异步API调用错误: {str(e)}")
-        return None
+    response, _ = await ChatGPT_API_with_finish_reason_async(model, prompt, api_key, chat_history)
+    return response
 
 def get_json_content(response):
     start_idx = response.find("```json")
@@ -126,6 +1162,9 @@ def get_json_content(response):
          
 
 def extract_json(content):
+    if not content:
+        logging.error("Failed to extract JSON: empty response")
+        return {}
     try:
         # First, try to extract JSON enclosed within ```json and ```
         start_idx = content.find("```json")
@@ -247,7 +1286,293 @@ def get_last_node(structure):
     return structure[-1]
 
 
+class PDFDocument:
+    """
+    A PDF opened once per run. Readers, metadata, page count, per-page text and the
+    page_list are created lazily and cached, so helpers taking a PDFDocument never re-parse the file.
+    """
+    def __init__(self, pdf_path, pdf_parser="PyPDF2"):
+        if isinstance(pdf_path, BytesIO):
+            self.source = pdf_path.getvalue()
+            self.path = None
+        elif isinstance(pdf_path, str) and os.path.isfile(pdf_path) and pdf_path.lower().endswith(".pdf"):
+            self.source = pdf_path
+            self.path = pdf_path
+        else:
+            raise ValueError("Unsupported input type. Expected a PDF file path or BytesIO object.")
+        self.pdf_parser = pdf_parser
+        self._readers = {}
+        self._page_texts = {}
+        self._page_lists = {}
+        self._title = None
+        self._content_hash = None
+
+    def reader(self, pdf_parser=None):
+        pdf_parser = pdf_parser or self.pdf_parser
+        if pdf_parser not in self._readers:
+            self._readers[pdf_parser] = _open_pdf(self.source, pdf_parser)
+        return self._readers[pdf_parser]
+
+    @property
+    def title(self):
+        if self._title is None:
+            if self.pdf_parser == "PyMuPDF":
+                meta = self.reader().metadata or {}
+                self._title = meta.get('title') or 'Untitled'
+            else:
+                meta = self.reader().metadata
+                self._title = meta.title if meta and meta.title else 'Untitled'
+        return self._title
+
+    @property
+    def name(self):
+        if self.path is not None:
+            return os.path.basename(self.path)
+        return sanitize_filename(self.title)
+
+    @property
+    def num_pages(self):
+        reader = self.reader()
+        return len(reader.pages) if self.pdf_parser == "PyPDF2" else len(reader)
+
+    @property
+    def content_hash(self):
+        if self._content_hash is None:
+            self._content_hash = pdf_content_hash(self.source)
+        return self._content_hash
+
+    def get_page_text(self, page_num):
+        """page_num is 0-based"""
+        if page_num not in self._page_texts:
+            reader = self.reader()
+            if self.pdf_parser == "PyPDF2":
+                self._page_texts[page_num] = reader.pages[page_num].extract_text()
+            else:
+                self._page_texts[page_num] = reader[page_num].get_text()
+        return self._page_texts[page_num]
+
+    def get_outline(self):
+        """
+        Embedded bookmarks as a flat list of (level, title, page_number), page_number 1-based or None.
+        """
+        reader = self.reader()
+        if self.pdf_parser == "PyMuPDF":
+            return [
+                (level, title, page if page > 0 else None)
+                for level, title, page, *_ in reader.get_toc(simple=True)
+            ]
+
+        outline = []
+        def walk(items, level):
+            for item in items:
+                if isinstance(item, list):
+                    walk(item, level + 1)
+                    continue
+                try:
+                    page_number = reader.get_destination_page_number(item) + 1
+                except Exception:
+                    page_number = None
+                outline.append((level, item.title, page_number))
+        try:
+            walk(getattr(reader, 'outline', None) or [], 1)
+        except Exception as e:
+            logging.warning(f"Failed to read PDF outline: {e}")
+            return []
+        return outline
+
+    def get_page_tokens(self, model="gpt-4o-2024-11-20", workers=1, cache_dir=None):
+        key = (model, self.pdf_parser)
+        if key not in self._page_lists:
+            page_list = get_page_tokens(self, model=model, pdf_parser=self.pdf_parser, workers=workers, cache_dir=cache_dir)
+            self._page_lists[key] = page_list
+            for page_num, (page_text, _) in enumerate(page_list):
+                self._page_texts.setdefault(page_num, page_text)
+        return self._page_lists[key]
+
+
+def normalize_title_text(text):
+    # lowercase and drop whitespace/punctuation so titles match page text regardless of spacing
+    return re.sub(r'[\W_]+', '', (text or '').lower())
+
+
+def substring_edit_distance(pattern, text):
+    # edit distance between pattern and its best matching substring of text (free start and end in text)
+    previous = [0] * (len(text) + 1)
+    for i, pattern_char in enumerate(pattern, 1):
+        current = [i] + [0] * len(text)
+        for j, text_char in enumerate(text, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (pattern_char != text_char))
+        previous = current
+    return min(previous)
+
+
+def title_match_score(title, text, max_title_chars=80, gram_size=3, max_anchors=8):
+    """
+    How well a section title occurs in a page text, in [0, 1].
+    1.0 is a verbatim hit after normalization; otherwise the edit similarity of the best
+    matching substring, searched only around places where pieces of the title occur.
+    """
+    title = normalize_title_text(title)[:max_title_chars]
+    if not title:
+        return 0.0
+    text = normalize_title_text(text)
+    if title in text:
+        return 1.0
+    if len(title) <= gram_size:
+        return 0.0
+
+    slack = len(title) // 4 + 1
+    step = max(1, (len(title) - gram_size) // 4)
+    windows = []
+    for offset in range(0, len(title) - gram_size + 1, step):
+        gram = title[offset:offset + gram_size]
+        position = text.find(gram)
+        for _ in range(max_anchors):
+            if position == -1:
+                break
+            start = max(0, position - offset - slack)
+            windows.append((start, min(len(text), start + len(title) + 2 * slack)))
+            position = text.find(gram, position + 1)
+    if not windows:
+        return 0.0
+
+    windows.sort()
+    merged = [list(windows[0])]
+    for start, end in windows[1:]:
+        if start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    distance = min(substring_edit_distance(title, text[start:end]) for start, end in merged)
+    return max(0.0, 1 - distance / len(title))
+
+
+class PageTextIndex:
+    """
+    Inverted index from normalized character n-grams to the physical indices (1-based) of the
+    pages containing them, so the candidate pages of a title can be ranked without scanning every page.
+    """
+    def __init__(self, gram_size=3):
+        self.gram_size = gram_size
+        self.postings = {}
+        self.num_pages = 0
+
+    def _grams(self, text):
+        text = normalize_title_text(text)
+        return {text[i:i + self.gram_size] for i in range(len(text) - self.gram_size + 1)}
+
+    def add_pages(self, pages):
+        # pages are (page_text, token_length) items appended after the pages already indexed
+        for page_text, _ in pages:
+            self.num_pages += 1
+            for gram in self._grams(page_text):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array('I')
+                posting.append(self.num_pages)
+
+    def query(self, title, first_page=None, last_page=None, top_k=5):
+        """
+        Rank pages in [first_page, last_page] by the share of the title's n-grams they contain.
+        Returns up to top_k (physical_index, score) pairs, best first; empty for titles too short to index.
+        """
+        title_grams = self._grams(title)
+        if not title_grams:
+            return []
+        first_page = first_page or 1
+        last_page = last_page or self.num_pages
+        counts = Counter()
+        for gram in title_grams:
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            # postings are sorted because pages are added in order
+            counts.update(posting[bisect.bisect_left(posting, first_page):bisect.bisect_right(posting, last_page)])
+        ranked = sorted(counts.items(), key=lambda entry: (-entry[1], entry[0]))[:top_k]
+        return [(page_number, count / len(title_grams)) for page_number, count in ranked]
+
+
+class PageList(list):
+    """
+    A page_list of (page_text, token_length) items that keeps a PageTextIndex of its pages.
+    Pages must be added through add_pages() for the index to follow; slices are plain lists.
+    """
+    def __init__(self, pages=()):
+        super().__init__()
+        self.text_index = PageTextIndex()
+        self.add_pages(pages)
+
+    def add_pages(self, pages):
+        self.extend(pages)
+        self.text_index.add_pages(pages)
+
+
+def get_page_text_index(page_list):
+    # the n-gram index of a full document page_list, or None for plain lists and partial slices
+    return getattr(page_list, 'text_index', None)
+
+
+class StageMemo:
+    """
+    Intermediate results of indexing one document that stay valid when meta_processor falls back
+    to another mode: transformed tocs, title-on-page check answers and page grouping.
+    Physical indices are absolute, so one memo serves the whole document including large-node passes.
+    """
+    def __init__(self):
+        self.transformed_tocs = {}
+        self.title_checks = {}
+        self.confirmed_pages = {}
+        self.computed = {}
+        self.reused = Counter()
+
+    def get_transformed_toc(self, toc_content):
+        toc = self.transformed_tocs.get(toc_content)
+        if toc is None:
+            return None
+        self.reused['toc_transformer'] += 1
+        return copy.deepcopy(toc)
+
+    def set_transformed_toc(self, toc_content, toc):
+        self.transformed_tocs[toc_content] = copy.deepcopy(toc)
+
+    def get_title_check(self, title, physical_index):
+        answer = self.title_checks.get((normalize_title_text(title), physical_index))
+        if answer is not None:
+            self.reused['title_check'] += 1
+        return answer
+
+    def set_title_check(self, title, physical_index, answer):
+        if not isinstance(physical_index, int) or answer not in ('yes', 'no'):
+            return
+        key = normalize_title_text(title)
+        self.title_checks[(key, physical_index)] = answer
+        if answer == 'yes':
+            self.confirmed_pages.setdefault(key, set()).add(physical_index)
+
+    def confirmed_page(self, title):
+        # the page a title was confirmed on, if it was confirmed on exactly one
+        pages = self.confirmed_pages.get(normalize_title_text(title))
+        return next(iter(pages)) if pages and len(pages) == 1 else None
+
+    def remember(self, stage, key, compute):
+        # cached result of compute() for (stage, key)
+        if (stage, key) in self.computed:
+            self.reused[stage] += 1
+        else:
+            self.computed[(stage, key)] = compute()
+        return self.computed[(stage, key)]
+
+    def stats(self):
+        return {
+            'transformed_tocs': len(self.transformed_tocs),
+            'title_checks': len(self.title_checks),
+            'reused': dict(self.reused),
+        }
+
+
 def extract_text_from_pdf(pdf_path):
+    if isinstance(pdf_path, PDFDocument):
+        return "".join(pdf_path.get_page_text(page_num) for page_num in range(pdf_path.num_pages))
     pdf_reader = PyPDF2.PdfReader(pdf_path)
     ###return text not list 
     text=""
@@ -257,17 +1582,22 @@ def extract_text_from_pdf(pdf_path):
     return text
 
 def get_pdf_title(pdf_path):
+    if isinstance(pdf_path, PDFDocument):
+        return pdf_path.title
     pdf_reader = PyPDF2.PdfReader(pdf_path)
     meta = pdf_reader.metadata
     title = meta.title if meta and meta.title else 'Untitled'
     return title
 
 def get_text_of_pages(pdf_path, start_page, end_page, tag=True):
-    pdf_reader = PyPDF2.PdfReader(pdf_path)
+    if isinstance(pdf_path, PDFDocument):
+        get_page_text = pdf_path.get_page_text
+    else:
+        pdf_reader = PyPDF2.PdfReader(pdf_path)
+        get_page_text = lambda page_num: pdf_reader.pages[page_num].extract_text()
     text = ""
     for page_num in range(start_page-1, end_page):
-        page = pdf_reader.pages[page_num]
-        page_text = page.extract_text()
+        page_text = get_page_text(page_num)
         if tag:
             text += f"<start_index_{page_num+1}>\n{page_text}\n<end_index_{page_num+1}>\n"
         else:
@@ -299,7 +1629,9 @@ def sanitize_filename(filename, replacement='-'):
 
 def get_pdf_name(pdf_path):
     # Extract PDF name
-    if isinstance(pdf_path, str):
+    if isinstance(pdf_path, PDFDocument):
+        pdf_name = pdf_path.name
+    elif isinstance(pdf_path, str):
         pdf_name = os.path.basename(pdf_path)
     elif isinstance(pdf_path, BytesIO):
         pdf_reader = PyPDF2.PdfReader(pdf_path)
@@ -413,33 +1745,281 @@ def add_preface_if_needed(data):
 
 
 
-def get_page_tokens(pdf_path, model="gpt-4o-2024-11-20", pdf_parser="PyPDF2"):
-    enc = tiktoken.encoding_for_model(model)
+_page_worker_state = {}
+
+
+def _init_page_worker(pdf_source, model, pdf_parser):
+    # runs once per worker process: keep the document bytes/path and the tokenizer around for all shards
+    _page_worker_state['pdf_source'] = pdf_source
+    _page_worker_state['model'] = model
+    _page_worker_state['pdf_parser'] = pdf_parser
+
+
+def _open_pdf(pdf_source, pdf_parser):
     if pdf_parser == "PyPDF2":
-        pdf_reader = PyPDF2.PdfReader(pdf_path)
-        page_list = []
-        for page_num in range(len(pdf_reader.pages)):
-            page = pdf_reader.pages[page_num]
-            page_text = page.extract_text()
-            token_length = len(enc.encode(page_text))
-            page_list.append((page_text, token_length))
-        return page_list
-    elif pdf_parser == "PyMuPDF":
-        if isinstance(pdf_path, BytesIO):
-            pdf_stream = pdf_path
-            doc = pymupdf.open(stream=pdf_stream, filetype="pdf")
-        elif isinstance(pdf_path, str) and os.path.isfile(pdf_path) and pdf_path.lower().endswith(".pdf"):
-            doc = pymupdf.open(pdf_path)
-        page_list = []
-        for page in doc:
-            page_text = page.get_text()
-            token_length = len(enc.encode(page_text))
-            page_list.append((page_text, token_length))
-        return page_list
+        if isinstance(pdf_source, bytes):
+            pdf_source = BytesIO(pdf_source)
+        return PyPDF2.PdfReader(pdf_source)
+    if isinstance(pdf_source, bytes):
+        return pymupdf.open(stream=pdf_source, filetype="pdf")
+    return pymupdf.open(pdf_source)
+
+
+def _extract_page_range(pdf_source, start_page, end_page, model, pdf_parser, doc=None):
+    if doc is None:
+        doc = _open_pdf(pdf_source, pdf_parser)
+    page_texts = []
+    for page_num in range(start_page, end_page):
+        if pdf_parser == "PyPDF2":
+            page_texts.append(doc.pages[page_num].extract_text())
+        else:
+            page_texts.append(doc[page_num].get_text())
+    token_lengths = encode_token_lengths(page_texts, model)
+    return list(zip(page_texts, token_lengths))
+
+
+def _extract_page_range_in_worker(start_page, end_page):
+    state = _page_worker_state
+    return _extract_page_range(state['pdf_source'], start_page, end_page, state['model'], state['pdf_parser'])
+
+
+PAGE_CACHE_MAGIC = b'PIPG'
+PAGE_CACHE_VERSION = 1
+
+
+def pdf_content_hash(pdf_source):
+    sha = hashlib.sha256()
+    if isinstance(pdf_source, bytes):
+        sha.update(pdf_source)
     else:
+        with open(pdf_source, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def save_page_list(path, page_list):
+    """
+    Store page_list as: header | (n+1) u64 text offsets | n u32 token counts | concatenated UTF-8 texts.
+    Written to a temp file first so readers never see a partial cache.
+    """
+    encoded = [page_text.encode('utf-8') for page_text, _ in page_list]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(struct.pack('<4sII', PAGE_CACHE_MAGIC, PAGE_CACHE_VERSION, len(page_list)))
+            f.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            f.write(struct.pack(f'<{len(page_list)}I', *[token_length for _, token_length in page_list]))
+            for data in encoded:
+                f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_page_list(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            magic, version, num_pages = struct.unpack_from('<4sII', buf, 0)
+            if magic != PAGE_CACHE_MAGIC or version != PAGE_CACHE_VERSION:
+                raise ValueError(f"Not a page cache file: {path}")
+            position = struct.calcsize('<4sII')
+            offsets = struct.unpack_from(f'<{num_pages + 1}Q', buf, position)
+            position += 8 * (num_pages + 1)
+            token_lengths = struct.unpack_from(f'<{num_pages}I', buf, position)
+            position += 4 * num_pages
+            return [
+                (buf[position + offsets[i]:position + offsets[i + 1]].decode('utf-8'), token_lengths[i])
+                for i in range(num_pages)
+            ]
+
+
+def _page_cache_path(document, model, pdf_parser, cache_dir):
+    encoding_name = get_encoding(model).name
+    return os.path.join(cache_dir, f"{document.content_hash}-{pdf_parser}-{encoding_name}.pages")
+
+
+def _load_cached_page_list(cache_path):
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            return load_page_list(cache_path)
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            logging.warning(f"Ignoring unreadable page cache {cache_path}: {e}")
+    return None
+
+
+def _save_cached_page_list(cache_path, page_list):
+    if cache_path:
+        try:
+            save_page_list(cache_path, page_list)
+        except OSError as e:
+            logging.warning(f"Failed to write page cache {cache_path}: {e}")
+
+
+def get_page_tokens(pdf_path, model="gpt-4o-2024-11-20", pdf_parser="PyPDF2", workers=1, min_pages_per_worker=32, cache_dir=None):
+    """
+    Extract (page_text, token_length) for every page.
+    With workers > 1 (0 means one per CPU) page ranges are sharded across processes that each
+    open the document themselves; documents too small to be worth it are parsed in-process.
+    With cache_dir set, results are reused across runs, keyed on the PDF content hash, the parser and the tokenizer.
+    The returned PageList also carries an n-gram index of the page texts (PageTextIndex).
+    """
+    if pdf_parser not in ("PyPDF2", "PyMuPDF"):
         raise ValueError(f"Unsupported PDF parser: {pdf_parser}")
+    document = pdf_path if isinstance(pdf_path, PDFDocument) else PDFDocument(pdf_path, pdf_parser)
+
+    cache_path = _page_cache_path(document, model, pdf_parser, cache_dir) if cache_dir else None
+    page_list = _load_cached_page_list(cache_path)
+    if page_list is not None:
+        return PageList(page_list)
+
+    page_list = PageList()
+    for chunk in _iter_page_chunks(document, model, pdf_parser, workers, min_pages_per_worker):
+        page_list.add_pages(chunk)
+    _save_cached_page_list(cache_path, page_list)
+    return page_list
+
+
+def _iter_page_chunks(document, model, pdf_parser, workers, min_pages_per_worker, chunk_size=None, head_pages=0, reader=None):
+    # yields lists of (page_text, token_length) in page order; the first chunk covers head_pages when given.
+    # Callers running in another thread than the users of document.reader() pass a reader of their own.
+    reader = reader or document.reader(pdf_parser)
+    num_pages = len(reader.pages) if pdf_parser == "PyPDF2" else len(reader)
+
+    if not workers:
+        workers = os.cpu_count() or 1
+    workers = min(workers, num_pages // min_pages_per_worker)
+    if workers <= 1:
+        for start, end in _page_shards(num_pages, chunk_size or num_pages, head_pages):
+            yield _extract_page_range(document.source, start, end, model, pdf_parser, doc=reader)
+        return
+
+    # a few shards per worker so that slow pages (scans, huge tables) do not leave workers idle
+    shard_size = math.ceil(num_pages / (workers * 4))
+    # PageStream runs this while the event loop thread holds sockets, the cache lock and logging locks;
+    # forked workers could inherit those locks held, spawned ones start clean
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_page_worker,
+                             initargs=(document.source, model, pdf_parser),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(_extract_page_range_in_worker, start, end)
+            for start, end in _page_shards(num_pages, shard_size, head_pages)
+        ]
+        for future in futures:
+            yield future.result()
+
+
+def _page_shards(num_pages, shard_size, head_pages=0):
+    shards = []
+    start = 0
+    if 0 < head_pages < num_pages:
+        shards.append((0, head_pages))
+        start = head_pages
+    shard_size = max(1, shard_size)
+    for shard_start in range(start, num_pages, shard_size):
+        shards.append((shard_start, min(shard_start + shard_size, num_pages)))
+    return shards
+
+
+class PageStream:
+    """
+    A page_list that fills up in a background thread, so the first pipeline stages can start
+    on the first pages while the rest of the document is still being extracted.
+    len() is the total page count from the start; use wait_for() before indexing pages that may
+    not have arrived yet, and result() for the complete list.
+    """
+    def __init__(self, document, model="gpt-4o-2024-11-20", workers=1, min_pages_per_worker=32,
+                 cache_dir=None, head_pages=20, chunk_size=8):
+        self.document = document
+        self.model = model
+        self.workers = workers
+        self.min_pages_per_worker = min_pages_per_worker
+        self.cache_dir = cache_dir
+        self.head_pages = head_pages
+        self.chunk_size = chunk_size
+        self.pages = PageList()
+        self.total = document.num_pages
+        self._error = None
+        self._waiters = []
+        self._loop = None
+        self._task = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = self._loop.run_in_executor(None, self._produce)
+        return self
+
+    def _produce(self):
+        pdf_parser = self.document.pdf_parser
+        cache_path = _page_cache_path(self.document, self.model, pdf_parser, self.cache_dir) if self.cache_dir else None
+        try:
+            page_list = _load_cached_page_list(cache_path)
+            if page_list is not None:
+                self._publish(page_list)
+                return self.pages
+            # neither PyPDF2 readers nor PyMuPDF documents are thread-safe, and the pipeline keeps using
+            # document.reader() (outline, metadata) while this thread extracts pages
+            reader = _open_pdf(self.document.source, pdf_parser)
+            for chunk in _iter_page_chunks(self.document, self.model, pdf_parser, self.workers,
+                                           self.min_pages_per_worker, self.chunk_size, self.head_pages, reader=reader):
+                self._publish(chunk)
+        except BaseException as e:
+            self._error = e
+            self._loop.call_soon_threadsafe(self._wake)
+            raise
+        _save_cached_page_list(cache_path, self.pages)
+        return self.pages
+
+    def _publish(self, chunk):
+        self.pages.add_pages(chunk)
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        pending = []
+        for count, future in self._waiters:
+            if future.done():
+                continue
+            if self._error is not None:
+                future.set_exception(self._error)
+            elif len(self.pages) >= count:
+                future.set_result(None)
+            else:
+                pending.append((count, future))
+        self._waiters = pending
+
+    async def wait_for(self, count):
+        """wait until the first count pages (capped at the document length) are available"""
+        count = min(count, self.total)
+        if self._error is not None:
+            raise self._error
+        if len(self.pages) >= count:
+            return
+        future = self._loop.create_future()
+        self._waiters.append((count, future))
+        await future
+
+    async def result(self):
+        page_list = await self._task
+        self.document._page_lists[(self.model, self.document.pdf_parser)] = page_list
+        return page_list
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, index):
+        return self.pages[index]
+
+
+async def wait_for_pages(page_list, count):
+    if isinstance(page_list, PageStream):
+        await page_list.wait_for(count)
 
-        
 
 def get_text_of_pdf_pages(pdf_pages, start_page, end_page):
     text = ""
@@ -454,6 +2034,8 @@ def get_text_of_pdf_pages_with_labels(pdf_pages, start_page, end_page):
     return text
 
 def get_number_of_pages(pdf_path):
+    if isinstance(pdf_path, PDFDocument):
+        return pdf_path.num_pages
     pdf_reader = PyPDF2.PdfReader(pdf_path)
     num = len(pdf_reader.pages)
     return num
@@ -598,7 +2180,7 @@ async def generate_summaries_for_structure(structure, model=None):
     return structure
 
 
-def generate_doc_description(structure, model=None):
+async def generate_doc_description(structure, model=None):
     prompt = f"""Your are an expert in generating descriptions for a document.
     You are given a structure of a document. Your task is to generate a one-sentence description for the document, which makes it easy to distinguish the document from other documents.
         
@@ -606,7 +2188,7 @@ def generate_doc_description(structure, model=None):
     
     Directly return the description, do not include any other text.
     """
-    response = ChatGPT_API(model, prompt)
+    response = await ChatGPT_API_async(model, prompt)
     return response
 
 
@@ -1,6 +1,7 @@
 import argparse
 from pageindex import *
 import os
+import time
 
 # 默认配置
 DEFAULT_MODEL = "deepseek-chat"
@@ -28,8 +29,24 @@ if __name__ == "__main__":
                       help='Whether to add summary to the node')
     parser.add_argument('--if-add-doc-description', type=str, default='yes',
                       help='Whether to add doc description to the doc')
+    parser.add_argument('--llm-backend', type=str, default='openai', choices=['openai', 'record', 'replay'],
+                      help='LLM backend: call the API, record calls to a cassette, or replay a cassette offline')
+    parser.add_argument('--llm-cassette', type=str, default='./cassettes/llm_cassette.jsonl',
+                      help='Cassette file used by the record/replay backends')
+    parser.add_argument('--serve-llm', type=int, default=None, metavar='PORT',
+                      help='Serve the cassette as a local OpenAI-compatible endpoint on PORT instead of parsing a PDF')
     args = parser.parse_args()
 
+    if args.serve_llm is not None:
+        server = serve_llm_backend(ReplayBackend(args.llm_cassette), port=args.serve_llm)
+        print(f'Serving {args.llm_cassette} at http://127.0.0.1:{args.serve_llm}/v1')
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
+        raise SystemExit(0)
+
     # 设置环境变量
     os.environ["CHATGPT_API_KEY"] = args.api_key
     os.environ["CHATGPT_BASE_URL"] = args.api_base
@@ -42,7 +59,9 @@ if __name__ == "__main__":
         max_token_num_each_node=args.max_tokens_per_node,
         if_add_node_id=args.if_add_node_id,
         if_add_node_summary=args.if_add_node_summary,
-        if_add_doc_description=args.if_add_doc_description
+        if_add_doc_description=args.if_add_doc_description,
+        llm_backend=args.llm_backend,
+        llm_cassette_path=args.llm_cassette
     )
 
     # Process the PDF